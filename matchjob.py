@@ -1,5 +1,6 @@
 from psetpartners.admin import make_matches, send_poolme_links, send_checkins, send_uncap_requests
-make_matches(forcelive=True)
+# stop optimizing after 30 minutes (5 per class) so that the run finishes well before midnight
+make_matches(forcelive=True, workers=0, time_limit=1800, class_time_limit=300)
 send_poolme_links(forcelive=True,preview=False)
 send_checkins(forcelive=True,preview=False)
 send_uncap_requests(forcelive=True,preview=False)
@@ -1,8 +1,8 @@
-import logging, datetime
+import logging, datetime, json
 from psycodict import DelayCommit
 from .app import send_email, livesite
 from .config import Configuration
-from .dbwrapper import getdb, db_islive
+from .dbwrapper import getdb, db_islive, bump_student_version, reset_class_stats
 from .people import get_kerb_data
 from .utils import current_term, current_year
 from .match import match_all
@@ -134,6 +134,7 @@ def send_checkins(forcelive=False, preview=True):
                     logger.info("Sending checkin email: %s to %s" % (subject, kerb))
                     send_email(email_address(kerb), subject, body+signature)
                     db.classlist.update({'class_id': c['id'], 'kerb': kerb}, {'checkin_pending': False}, resort=False)
+                    bump_student_version(kerb)
                     log_event(kerb, 'checkin', {'class_id': c['id']})
     logfile = admin_logger_filename(logger)
     clear_admin_logger(logger)
@@ -203,16 +204,16 @@ def clear_admin_logger(logger):
     logger.info("Ending %s log" % logger.name)
     logger.handlers.clear()
 
-def preview_matches(forcelive=False):
+def preview_matches(forcelive=False, workers=1, time_limit=None, class_time_limit=None):
     logger = create_admin_logger('match', forcelive=forcelive, preview=True)
-    results = match_all(forcelive=forcelive, preview=True, vlog=logger)
+    results = match_all(forcelive=forcelive, preview=True, vlog=logger, workers=workers, time_limit=time_limit, class_time_limit=class_time_limit)
     logfile = admin_logger_filename(logger)
     clear_admin_logger(logger)
     return results, logfile
 
-def compute_matches(forcelive=False):
+def compute_matches(forcelive=False, workers=1, time_limit=None, class_time_limit=None):
     logger = create_admin_logger('cmatch', forcelive=forcelive, preview=False)
-    results = match_all(forcelive=forcelive, preview=False, vlog=logger)
+    results = match_all(forcelive=forcelive, preview=False, vlog=logger, workers=workers, time_limit=time_limit, class_time_limit=class_time_limit)
     logfile = admin_logger_filename(logger)
     clear_admin_logger(logger)
     return results, logfile
@@ -232,7 +233,7 @@ def apply_matches(results, forcelive=False, email_test=False):
     return logfile
 
 # compute_matches + apply_matches
-def make_matches(forcelive=False, email_test=False):
+def make_matches(forcelive=False, email_test=False, workers=1, time_limit=None, class_time_limit=None):
     from . import app
 
     db = getdb(forcelive)
@@ -241,7 +242,7 @@ def make_matches(forcelive=False, email_test=False):
         match_run = r['value']+1 if r else 0
         db.globals.update({'key':'match_run'},{'timestamp': datetime.datetime.now(), 'value': match_run}, resort=False)
         logger = create_admin_logger('match', forcelive=forcelive, preview=False)
-        results = match_all(forcelive=forcelive, vlog=logger)
+        results = match_all(forcelive=forcelive, vlog=logger, workers=workers, time_limit=time_limit, class_time_limit=class_time_limit)
         if results:
             with app.app_context():
                 process_matches (results, match_run=match_run, forcelive=forcelive, email_test=email_test, vlog=logger)
@@ -267,6 +268,55 @@ def rematch_groups(group_ids, forcelive=False, email_test=False):
     clear_admin_logger(logger)
     return logfile
 
+def _comparable_counts(counts):
+    from .student import add_counts
+    # stored counts are json (string keys) and have nested entries that dropped to zero pruned, so normalize both sides
+    return add_counts({}, json.loads(json.dumps(counts)))
+
+def check_counts(forcelive=False):
+    """
+    Compares the class_stats rows of the classes in the current term and the counts_cache entries for the current term
+    with counts computed from scratch, logging any differences.  This reads every class in the term, so it is meant to
+    be run by hand (e.g. after testing joins, leaves, or matches) rather than as part of a regular job.
+    Returns the number of rows that differ and the log file (note that counts_cache entries can legitimately be up to
+    student.COUNTS_CACHE_TTL seconds out of date).
+    """
+    from .student import class_stats_counts, term_counts, COUNTS_CACHE_TTL
+    from .dbwrapper import students_in_class
+
+    def differences(stored, computed):
+        stored, computed = _comparable_counts(stored), _comparable_counts(computed)
+        return sorted(k for k in set(stored) | set(computed) if stored.get(k) != computed.get(k))
+
+    db = getdb(forcelive)
+    logger = create_admin_logger('counts', forcelive=forcelive, preview=True)
+    n = 0
+    now = datetime.datetime.now()
+    year, term = current_year(), current_term()
+    for c in db.classes.search({'year': year, 'term': term}, projection=['id', 'class_number']):
+        r = db.class_stats.lucky({'class_id': c['id']}, projection=['counts', 'timestamp'])
+        if r is None:
+            continue
+        computed = class_stats_counts(students_in_class(c['id']), db.groups.search({'class_id': c['id']}, projection=['visibility', 'size', 'max']))
+        keys = differences(r['counts'], computed)
+        if keys:
+            n += 1
+            logger.warning("class_stats row for %s (updated %s) differs from scratch counts in %s" % (c['class_number'], r['timestamp'], keys))
+    prefix = "%s/%s/" % (year, term)
+    for r in db.counts_cache.search({}, projection=['name', 'value', 'timestamp']):
+        if not r['name'].startswith(prefix):
+            continue
+        opts = r['name'][len(prefix):].split(',') if r['name'][len(prefix):] else []
+        keys = differences(r['value'], term_counts(opts, year=year, term=term))
+        if keys:
+            n += 1
+            stale = r['timestamp'] + datetime.timedelta(seconds=COUNTS_CACHE_TTL) < now
+            logger.warning("counts_cache entry %s (updated %s%s) differs from scratch counts in %s" % (r['name'], r['timestamp'], ", stale" if stale else "", keys))
+    logger.info("Checked cached counts, %d rows differ from scratch counts" % n)
+    logfile = admin_logger_filename(logger)
+    clear_admin_logger(logger)
+    return n, logfile
+
 def fill_from_people():
     db = getdb(True)
 
@@ -281,6 +331,7 @@ def fill_from_people():
             print("No displayName data available for kerb %s" % kerb)
             continue
         db.students.update({'kerb': kerb}, {'full_name': data['full_name']},resort=False)
+        bump_student_version(kerb)
         print("Full name %s for %s" % (data['full_name'], kerb))
 
     for kerb in db.students.search({'year': None}, projection='kerb'):
@@ -293,6 +344,8 @@ def fill_from_people():
             print("No year available for kerb %s" % kerb)
             continue
         db.students.update({'kerb': kerb, 'year': None}, {'year': data['year']})
+        bump_student_version(kerb)
+        reset_class_stats(db.classlist.search({'kerb': kerb, 'year': current_year(), 'term': current_term()}, projection='class_id'))
         print("Year %d for kerb %s" % (data['year'], kerb))
 
     for kerb in db.students.search({'departments': []}, projection='kerb'):
@@ -305,4 +358,6 @@ def fill_from_people():
             print("No departments data available for kerb %s" % kerb)
             continue
         db.students.update({'kerb': kerb, 'departments': []}, {'departments': data['departments']},resort=False)
+        bump_student_version(kerb)
+        reset_class_stats(db.classlist.search({'kerb': kerb, 'year': current_year(), 'term': current_term()}, projection='class_id'))
         print("Departments %s for kerb %s" % (data['departments'], kerb))
@@ -0,0 +1,85 @@
+"""
+Harness for comparing the matching engines in match.py on the same pools: record_pools saves the pools of students
+waiting to be matched in the current term to a file, and benchmark_engines runs several engines on the recorded pools
+(without accessing the database) and reports wall time, peak memory, total compatibility and violated requirements.
+
+For example, from a python shell in the root directory:
+
+    from psetpartners.benchmark import record_pools, benchmark_engines
+    record_pools("pools.json", forcelive=True)
+    benchmark_engines("pools.json", ["default", "swaps"])
+"""
+import json, time, tracemalloc
+from .dbwrapper import getdb
+from .match import load_pools, match_pool, engines, TimeBudget, Student, Group, affinities, styles
+from .utils import current_year, current_term, null_logger
+
+def record_pools(filename, forcelive=False, preview=True):
+    """
+    Writes the pools of the active classes in the current term to filename (as json), including students in the pool
+    (preview=True) or students waiting to be matched (preview=False).  Returns the number of pools recorded.
+    """
+    db = getdb(forcelive)
+    query = {'active': True, 'year': current_year(), 'term': current_term()}
+    classes = list(db.classes.search(query, ["id", "class_name", "class_number"]))
+    pools = load_pools([c['id'] for c in classes], preview)
+    records = [{'class': c, 'pool': pools[c['id']]} for c in classes if pools.get(c['id'])]
+    with open(filename, "w") as fp:
+        json.dump(records, fp, default=str)
+    return len(records)
+
+def score_groups(pool, groups):
+    """
+    Returns the total compatibility of a list of groups (lists of kerbs) formed from a pool, and the number of
+    requirements (strength 5 preferences, blocked kerbs and required sizes) the groups violate.
+    """
+    students = {}
+    for properties, preferences, strengths in pool:
+        students[properties["kerb"]] = Student(properties, preferences, strengths)
+    score, violations = 0, 0
+    for kerbs in groups:
+        G = Group([students[k] for k in kerbs])
+        score += G.compatibility()
+        violations += sum(1 for S in G.students for q in affinities + styles + ["blocked_kerbs", "size"] if S.score(q, G) <= -10**6)
+    return score, violations
+
+def benchmark_engines(filename, names=None, class_time_limit=None, verbose=False, vlog=null_logger()):
+    """
+    Runs the matching engines with the specified names (all of them by default) on the pools recorded in filename
+    and prints a summary for each engine (and for each pool if verbose is set).  Each engine is run twice on each
+    pool, once to measure wall time and once to measure peak memory (using tracemalloc, which slows things down).
+    Returns a dictionary of totals keyed by name.
+    """
+    with open(filename) as fp:
+        records = json.load(fp)
+    results = {}
+    for name in names or list(engines):
+        totals = {'pools': 0, 'time': 0.0, 'memory': 0, 'score': 0, 'violations': 0, 'unmatched': 0}
+        for r in records:
+            c, pool = r['class'], [tuple(t) for t in r['pool']]
+            start = time.time()
+            groups, only, other = match_pool(c, pool, vlog, TimeBudget(class_time_limit), engine=name)
+            elapsed = time.time() - start
+            tracemalloc.start()
+            try:
+                match_pool(c, pool, null_logger(), TimeBudget(class_time_limit), engine=name)
+                memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            score, violations = score_groups(pool, groups)
+            unmatched = len(only) + len(other)
+            if verbose:
+                print("%-10s %-10s %4d students: %7.3fs %8.1fMB score %10d violations %3d unmatched %3d" %
+                      (name, c['class_number'], len(pool), elapsed, memory / 2**20, score, violations, unmatched))
+            totals['pools'] += 1
+            totals['time'] += elapsed
+            totals['memory'] = max(totals['memory'], memory)
+            totals['score'] += score
+            totals['violations'] += violations
+            totals['unmatched'] += unmatched
+        results[name] = totals
+    print("%-10s %6s %9s %10s %12s %10s %9s" % ("engine", "pools", "time", "peak MB", "score", "violations", "unmatched"))
+    for name, t in results.items():
+        print("%-10s %6d %8.2fs %10.1f %12d %10d %9d" %
+              (name, t['pools'], t['time'], t['memory'] / 2**20, t['score'], t['violations'], t['unmatched']))
+    return results
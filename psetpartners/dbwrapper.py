@@ -58,7 +58,9 @@ test_redirects = [
     'classes',
     'requests',
     'surveys',
-    'survey_responses'
+    'survey_responses',
+    'counts_cache',
+    'class_stats'
 ]
 
 def test_redirect(str):
@@ -156,22 +158,140 @@ WHERE {cs}.{year} = %s AND {cs}.{term} = %s AND {cs}.{class_number} = %s
     )
     return list(DBIterator(db._execute(cmd, [year, term, class_number]), ["count"]))[0]['count']
 
-# returns data for students in a particular class
-def students_in_class(class_id, projection=[]):
+# increments the version of a class (used to invalidate cached group suggestions, see match.ranked_groups), atomically so concurrent updates are not lost
+def bump_class_version(class_id):
+    c = "classes" if livesite() or get_forcelive() else "test_classes"
+    cmd = SQLWrapper(
+        """
+UPDATE {c} SET {version} = COALESCE({c}.{version}, 0) + 1
+WHERE {c}.{id} = %s
+        """,
+        {'c':c}
+    )
+    db._execute(cmd, [class_id])
+
+# increments the data version of a student (used to invalidate cached user objects, see student.cached_student)
+def bump_student_version(kerb):
+    s = "students" if livesite() or get_forcelive() else "test_students"
+    cmd = SQLWrapper(
+        """
+UPDATE {s} SET {version} = COALESCE({s}.{version}, 0) + 1
+WHERE {s}.{kerb} = %s
+        """,
+        {'s':s}
+    )
+    db._execute(cmd, [kerb])
+
+# returns the data version of a student as a triple (version of the student, sum of the versions of their classes in the term, number of classes),
+# which changes whenever the student's row or classlist rows, or any group in one of their classes changes (None if there is no such student)
+def student_data_version(kerb, year=current_year(), term=current_term()):
+    s, cs, c = ("students", "classlist", "classes") if livesite() or get_forcelive() else ("test_students", "test_classlist", "test_classes")
+    cmd = SQLWrapper(
+        """
+SELECT COALESCE({s}.{version}, 0), COALESCE(SUM({c}.{version}), 0), COUNT({c}.{id})
+FROM {s} LEFT JOIN {cs} ON {cs}.{student_id} = {s}.{id} AND {cs}.{year} = %s AND {cs}.{term} = %s
+         LEFT JOIN {c} ON {c}.{id} = {cs}.{class_id}
+WHERE {s}.{kerb} = %s
+GROUP BY {s}.{id}
+        """,
+        {'s':s, 'cs':cs, 'c':c}
+    )
+    L = list(DBIterator(db._execute(cmd, [year, term, kerb]), ["version", "class_versions", "classes"]))
+    return (L[0]["version"], L[0]["class_versions"], L[0]["classes"]) if L else None
+
+# atomically claims the right to refresh the cached counts with the specified name (see student.cached_term_counts), returns
+# True if no other worker has claimed it since the specified expiration time (so at most one worker refreshes a stale entry)
+def claim_counts_refresh(name, now, expired):
+    t = "counts_cache" if livesite() or get_forcelive() else "test_counts_cache"
+    cmd = SQLWrapper(
+        """
+UPDATE {t} SET {refreshing} = %s
+WHERE {t}.{name} = %s AND ({t}.{refreshing} IS NULL OR {t}.{refreshing} < %s)
+RETURNING {t}.{name}
+        """,
+        {'t':t}
+    )
+    return len(list(DBIterator(db._execute(cmd, [now, name, expired]), ["name"]))) > 0
+
+# returns the counts in the class_stats row for a class (see student.ClassStatsUpdate), locking the row until the end of the
+# current transaction so that concurrent updates are not lost (None if there is no row)
+def lock_class_stats(class_id):
+    t = "class_stats" if livesite() or get_forcelive() else "test_class_stats"
+    cmd = SQLWrapper(
+        """
+SELECT {t}.{counts} FROM {t}
+WHERE {t}.{class_id} = %s
+FOR UPDATE
+        """,
+        {'t':t}
+    )
+    L = list(DBIterator(db._execute(cmd, [class_id]), ["counts"]))
+    return L[0]["counts"] if L else None
+
+# discards the class_stats rows for the specified classes, used after changes that are not applied as deltas (they will be recomputed when next needed)
+def reset_class_stats(class_ids):
+    getdb().class_stats.delete({'class_id': {'$in': list(class_ids)}})
+
+# returns data for students in a particular class (optionally only those with the specified student ids)
+def students_in_class(class_id, projection=[], student_ids=None):
     s, cs = ("students", "classlist") if livesite() or get_forcelive() else ("test_students", "test_classlist")
     # note that the order of cols must match the order they appear in the SELECT below
     cols = ['id', 'kerb', 'preferred_name', 'preferred_pronouns', 'full_name', 'email', 'departments', 'year', 'gender',
             'location', 'timezone', 'hours', 'properties', 'preferences', 'strengths', 'status']
+    where, values = "{cs}.{class_id} = %s", [class_id]
+    if student_ids is not None:
+        where, values = where + " AND {cs}.{student_id} = ANY(%s)", values + [list(student_ids)]
     cmd = SQLWrapper(
         """
 SELECT {s}.{id}, {s}.{kerb}, {s}.{preferred_name}, {s}.{preferred_pronouns}, {s}.{full_name}, {s}.{email}, {s}.{departments}, {s}.{year},
        {s}.{gender}, {s}.{location}, {s}.{timezone}, {s}.{hours}, {cs}.{properties}, {cs}.{preferences}, {cs}.{strengths}, {cs}.{status}
 FROM {cs} JOIN {s} ON {s}.{id} = {cs}.{student_id}
-WHERE {cs}.{class_id} = %s
+WHERE """ + where + """
         """,
         {'s':s, 'cs':cs}
     )
-    return DBIterator(db._execute(cmd, [class_id]), cols, projection)
+    return DBIterator(db._execute(cmd, values), cols, projection)
+
+# returns data relevant to matching for students with the specified status in any of the specified classes (ordered by classlist id)
+def students_in_pools(class_ids, status, projection=[]):
+    s, cs, c = ("students", "classlist", "classes") if livesite() or get_forcelive() else ("test_students", "test_classlist", "test_classes")
+    # note that the order of cols must match the order they appear in the SELECT below
+    cols = ['class_id', 'id', 'kerb', 'blocked_kerbs', 'gender', 'hours', 'year', 'departments', 'timezone', 'properties', 'preferences', 'strengths']
+    cmd = SQLWrapper(
+        """
+SELECT {cs}.{class_id}, {s}.{id}, {s}.{kerb}, {s}.{blocked_kerbs}, {s}.{gender}, {s}.{hours}, {s}.{year}, {s}.{departments}, {s}.{timezone},
+       {cs}.{properties}, {cs}.{preferences}, {cs}.{strengths}
+FROM {cs} JOIN {s} ON {s}.{id} = {cs}.{student_id}
+          JOIN {c} ON {c}.{id} = {cs}.{class_id}
+WHERE {c}.{id} = ANY(%s) AND {cs}.{status} = %s
+ORDER BY {cs}.{id}
+        """,
+        {'s':s, 'cs':cs, 'c':c}
+    )
+    return DBIterator(db._execute(cmd, [list(class_ids), status]), cols, projection)
+
+# returns data relevant to matching for the members of the groups in a class that a student could join: visible groups that are not full,
+# have no pending request, and that the student has not previously left (ordered by group id, one row per member)
+def open_groups_in_class(class_id, kerb, projection=[]):
+    s, cs, g, cgs, cgl = ("students", "classlist", "groups", "grouplist", "grouplistleft") if livesite() or get_forcelive() else ("test_students", "test_classlist", "test_groups", "test_grouplist", "test_grouplistleft")
+    # note that the order of cols must match the order they appear in the SELECT below
+    cols = ['group_id', 'visibility', 'size', 'max', 'group_preferences', 'id', 'kerb', 'blocked_kerbs', 'gender', 'hours', 'year', 'departments', 'timezone',
+            'properties', 'preferences', 'strengths']
+    cmd = SQLWrapper(
+        """
+SELECT {g}.{id}, {g}.{visibility}, {g}.{size}, {g}.{max}, {g}.{preferences},
+       {s}.{id}, {s}.{kerb}, {s}.{blocked_kerbs}, {s}.{gender}, {s}.{hours}, {s}.{year}, {s}.{departments}, {s}.{timezone},
+       {cs}.{properties}, {cs}.{preferences}, {cs}.{strengths}
+FROM {g} JOIN {cgs} ON {cgs}.{group_id} = {g}.{id}
+         JOIN {s} ON {s}.{id} = {cgs}.{student_id}
+         JOIN {cs} ON {cs}.{class_id} = {g}.{class_id} AND {cs}.{student_id} = {s}.{id}
+WHERE {g}.{class_id} = %s AND {g}.{visibility} >= 1 AND {g}.{request_id} IS NULL AND ({g}.{max} IS NULL OR {g}.{size} < {g}.{max})
+      AND NOT EXISTS (SELECT 1 FROM {cgl} WHERE {cgl}.{group_id} = {g}.{id} AND {cgl}.{kerb} = %s)
+ORDER BY {g}.{id}, {cgs}.{id}
+        """,
+        {'s':s, 'cs':cs, 'g':g, 'cgs':cgs, 'cgl':cgl}
+    )
+    return DBIterator(db._execute(cmd, [class_id, kerb]), cols, projection)
 
 # this will return multiple rows for students in more than one group (which should not happen), empty groups will not be returned
 def students_groups_in_class(class_id, projection=[]):
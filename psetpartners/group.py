@@ -1,8 +1,8 @@
 import datetime
 from psycodict import DelayCommit
 from .app import send_email, livesite
-from .utils import current_term, current_year, hours_from_default, null_logger
-from .dbwrapper import getdb, get_forcelive, db_islive
+from .utils import current_term, current_year, null_logger, Availability, AvailabilityCounts
+from .dbwrapper import getdb, get_forcelive, db_islive, bump_class_version, bump_student_version, reset_class_stats
 
 FIRST_MEETING_OFFSET = 36 # first meeting is at least this many hours after the email is sent
 
@@ -98,13 +98,10 @@ Please contact us if you have any questions or concerns.
 
 
 def normalized_hours(s):
-    offset = hours_from_default(s["timezone"])
-    hours = s["hours"]
-    return tuple(hours[(i-offset)%168] for i in range(168))
+    return Availability.from_hours(s["hours"], s["timezone"])
 
 def available_hours(S):
-    x = list(zip(*[normalized_hours(s) for s in S]))
-    return [i for i in range(168) if all(x[i])]
+    return list(AvailabilityCounts(normalized_hours(s) for s in S).overlap())
 
 def student_url(class_number):
     url = "https://psetpartners.mit.edu/student" if (livesite() or get_forcelive()) else "https://psetpartners-test.mit.edu/student"
@@ -158,6 +155,8 @@ def disband_group (group_id, rematch=False, forcelive=False, email_test=False, v
         kerbs = [r['kerb'] for r in members]
         db.groups.delete({'id': group_id})
         db.grouplist.delete({'group_id': group_id})
+        bump_class_version(g['class_id'])
+        reset_class_stats([g['class_id']])
         log_event ('admin', 'disband', detail={'group_id': g['id'], 'group_name': g['group_name'], 'members': kerbs})
         vlog.info("Disbanded group %s (%d) in %s (%d) with %d members %s" % (g['group_name'], g['id'], g['class_number'], g['class_id'], len(kerbs), kerbs))
 
@@ -225,6 +224,8 @@ def create_group (class_id, kerbs, match_run=0, group_name='', forcelive=False,
         gs = [{'class_id': class_id, 'group_id': g['id'], 'student_id': s['id'], 'kerb': s['kerb'],
                'class_number': c['class_number'], 'year': c['year'], 'term': c['term']} for s in students]
         db.grouplist.insert_many(gs, resort=False)
+        bump_class_version(class_id)
+        reset_class_stats([class_id])
         now = datetime.datetime.now()
         for s in students:
             db.classlist.update({'class_id': class_id, 'student_id': s['id']}, {'status':1, 'status_timestamp': now, 'checkin_pending': True}, resort=False)
@@ -307,6 +308,8 @@ def process_matches (matches, match_run=-1, forcelive=False, email_test=False, v
             assert db.students.lookup(kerb), "Student %s not found" % kerb
             S = [t for t in rank_groups(class_id, kerb) if t[1] == 2]
             db.classlist.update({'class_id': class_id, 'kerb': kerb}, {'status': 0, 'status_timestamp': now}, resort=False)
+            bump_student_version(kerb)
+            reset_class_stats([class_id])
             if S and S[0][2] > -1000:
                 group_id = S[0][0]
                 group_name = db.groups.lucky({'id': group_id}, projection="group_name")
@@ -24,6 +24,9 @@ from .student import (
     Student,
     Instructor,
     AnonymousUser,
+    Principal,
+    cached_student,
+    materialized_sections,
     student_options,
     student_preferences,
     student_class_properties,
@@ -65,6 +68,11 @@ def is_safe_url(target):
 
 login_manager = LoginManager()
 
+def lightweight(f):
+    """ Marks a route that only needs to know who the caller is, load_user gives it a Principal rather than a Student or Instructor """
+    f.lightweight = True
+    return f
+
 @login_manager.user_loader
 def load_user(kerb):
     if not kerb:
@@ -75,7 +83,9 @@ def load_user(kerb):
         return AnonymousUser()
     full_name = session.get('displayname')
     try:
-        s = Student(kerb, full_name) if session.get("affiliation") == "student" else Instructor(kerb, full_name, affiliation=session.get("affiliation"))
+        if getattr(app.view_functions.get(request.endpoint), "lightweight", False):
+            return Principal(kerb, affiliation=session.get("affiliation"))
+        s = cached_student(kerb, full_name) if session.get("affiliation") == "student" else Instructor(kerb, full_name, affiliation=session.get("affiliation"))
         return s
     except Exception as err:
         msg = "load_user failed for {0}: {1}{2!r}".format(kerb, type(err).__name__, err.args)
@@ -99,6 +109,13 @@ def ctx_proc_userdata():
     }
     return userdata
 
+@app.after_request
+def log_materialized_sections(response):
+    sections = materialized_sections()
+    if sections:
+        app.logger.debug("%s %s loaded student sections %s" % (request.method, request.path, dict(sections)))
+    return response
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     next = request.args.get('next')
@@ -510,6 +527,7 @@ allowed_gopts = ["group_name", "visibility", "hours", "preferences", "strengths"
 
 @app.route("/_acknowledge")
 @login_required
+@lightweight
 def acknoledge():
     msgid = request.args.get('msgid')
     return current_user.acknowledge(msgid)
@@ -526,6 +544,7 @@ def confirm_conduct():
 
 @app.route("/_toggle")
 @login_required
+@lightweight
 def update_toggle():
     toggle = request.args.get('name')
     state = request.args.get('value')
@@ -533,6 +552,7 @@ def update_toggle():
 
 @app.route("/_counts")
 @login_required
+@lightweight
 def counts():
     classes = request.args.get('classes',"").split(",")
     copts = [x for x in request.args.get('opts',"").split(",") if x and x in allowed_copts]
@@ -540,6 +560,7 @@ def counts():
 
 @app.route("/_groups")
 @login_required
+@lightweight
 def groups():
     classes = request.args.get('classes',"").split(",")
     gopts = [x for x in request.args.get('opts',"").split(",") if x and x in allowed_gopts]
@@ -547,6 +568,7 @@ def groups():
 
 @app.route("/_counts_groups")
 @login_required
+@lightweight
 def counts_groups():
     classes = request.args.get('classes',"").split(",")
     copts = [x for x in request.args.get('opts',"").split(",") if x and x in allowed_copts]
@@ -1,9 +1,11 @@
-import datetime
-from .dbwrapper import getdb, db_islive
-from .utils import hours_from_default, current_year, current_term, null_logger
-from collections import defaultdict
+import datetime, logging, os, time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from .dbwrapper import getdb, db_islive, students_in_pools, open_groups_in_class, bump_class_version, reset_class_stats
+from .utils import Availability, AvailabilityCounts, current_year, current_term, null_logger
+from collections import defaultdict, OrderedDict
 from math import sqrt, floor, ceil
-from functools import lru_cache
+from heapq import heapify, heappush, heappop, nlargest
 
 # cols from student table relevant to matching
 student_properties = ["id", "kerb", "blocked_kerbs", "gender", "hours", "year", "departments", "timezone"]
@@ -11,6 +13,41 @@ student_properties = ["id", "kerb", "blocked_kerbs", "gender", "hours", "year",
 # preferences relevent to matching other than size
 affinities = ["gender_affinity", "confidence_affinity", "commitment_affinity", "departments_affinity", "year_affinity"]
 styles = ["forum", "start", "style"]
+# qualities for which Student.check compares a pair of students
+pair_qualities = ["blocked_kerbs"] + affinities + styles
+# index of each affinity and style in the compiled features of a Student (see Student.codes)
+quality_index = {q: k for k, q in enumerate(affinities + styles)}
+
+# rules for comparing compiled features (see Student.rules)
+SAME, DIFFERENT, OVERLAP = 1, 2, 3
+# modes for scoring tallies (see Student.scoring)
+ADDITIVE, NO_MISMATCH, SOME_MATCH = 0, 1, 2
+
+_value_codes = {}
+def _code(value):
+    """ Returns a small int that identifies value (which must be hashable), None if value is None """
+    if value is None:
+        return None
+    return _value_codes.setdefault(value, len(_value_codes))
+
+def _compare(rule, a, b):
+    """ Compares compiled features a and b (neither of which is None) using rule """
+    if rule == SAME:
+        return a == b
+    if rule == DIFFERENT:
+        return a != b
+    if rule == OVERLAP:
+        return bool(a & b)
+    raise RuntimeError
+
+def _mask(values):
+    """ Returns a bitmask with a bit for each of the values (used for departments), None if values is None """
+    if values is None:
+        return None
+    mask = 0
+    for v in values:
+        mask |= 1 << _code(v)
+    return mask
 
 class MatchError(ValueError):
     pass
@@ -103,100 +140,410 @@ def initial_assign(to_match, sizes):
                 add(remainder,3)
     return groups
 
+# maximum number of swaps kept in a SwapQueue (see SwapQueue.prune)
+SWAP_QUEUE_SIZE = 100000
+
+class SwapQueue(object):
+    """
+    Priority queue of candidate swaps (value, i, j) with i < j, popped in the same order as a reverse sorted list.
+    When groups change, the swaps they affect are rescored and pushed again; the outdated heap entries are
+    discarded lazily when they reach the top of the heap.
+
+    Only swaps that improve the score are kept (the others are rescored when one of their groups changes), and at most
+    about twice capacity of them: when there are more, only the best capacity swaps are kept and the members of the
+    others are remembered, their swaps are rescored once the queue runs dry.
+
+    If every student has a list of partners (see PairTable.set_partners), only swaps that move a student into a group
+    containing one of its partners are considered (a granular neighborhood), so the number of swaps scales with the
+    number of students times the number of partners rather than quadratically.
+    """
+    def __init__(self, groups, capacity=SWAP_QUEUE_SIZE):
+        self.groups = groups
+        self.capacity = capacity
+        self.heap = []
+        self.stamps = {}
+        self.counter = 0
+        self.dropped = set() # students with swaps dropped by prune
+        self.granular = bool(groups) and all(G.students[0].partners is not None for G in groups.values())
+        if self.granular:
+            # pairs currently in the queue by student, and students by partner (within groups)
+            self.students = {S.id: S for G in groups.values() for S in G.students}
+            self.pairs = defaultdict(set)
+            self.wanted = defaultdict(list)
+            for i, S in self.students.items():
+                for j in S.partners:
+                    if j in groups:
+                        self.wanted[j].append(i)
+            # students with an unsatisfied requirement may swap with anyone
+            self.unhappy = set()
+            for G in set(groups.values()):
+                self.update_unhappy(G)
+        self.scan(groups)
+
+    def scan(self, students):
+        """ Scores the swaps of the specified students (an iterable of ids) and adds them to the queue """
+        # swaps are pushed as they are scored so that prune keeps the queue bounded during the scan
+        for i, j, value in self.score(set(students)):
+            self.push(i, j, value, heap=False)
+        heapify(self.heap)
+
+    def score(self, students):
+        """ Yields triples (i, j, value) for the swaps of the specified students (a set of ids) that improve the score """
+        for a in students:
+            if self.granular:
+                pairs = self.neighborhood(a)
+            else:
+                pairs = ((a, b) if a < b else (b, a) for b in self.groups if b != a)
+            for i, j in pairs:
+                # each swap is scored once, for i if it is being scanned and for j otherwise
+                if a == (i if i in students else j):
+                    value = self.groups[i].evaluate_swap(i, j, self.groups[j])
+                    if value > 0:
+                        yield i, j, value
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def push(self, i, j, value, heap=True):
+        if value <= 0:
+            # swaps that do not improve the score are never made, so we only need to remember the ones that do
+            if (i, j) in self.stamps:
+                self.discard(i, j)
+            return
+        # the stamp identifies the current entry for the pair (i, j), older entries are stale
+        self.counter += 1
+        stamp = self.stamps[(i, j)] = self.counter
+        if self.granular:
+            self.pairs[i].add((i, j))
+            self.pairs[j].add((i, j))
+        entry = (-value, -i, -j, stamp)
+        if heap:
+            heappush(self.heap, entry)
+        else:
+            # during a scan the heap is an unordered list that is heapified at the end
+            self.heap.append(entry)
+        if len(self.heap) > 4 * len(self.stamps) + 64:
+            self.compact()
+        if len(self.stamps) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        """ Keeps the best capacity swaps and remembers the students whose swaps were dropped """
+        live = sorted(e for e in self.heap if self.stamps.get((-e[1], -e[2])) == e[3])
+        self.heap = live[:self.capacity]
+        for e in live[self.capacity:]:
+            i, j = -e[1], -e[2]
+            self.dropped.update((i, j))
+            self.discard(i, j)
+
+    def discard(self, i, j):
+        """ Removes the pair (i, j) from the queue (its heap entries become stale) """
+        del self.stamps[(i, j)]
+        if self.granular:
+            self.pairs[i].discard((i, j))
+            self.pairs[j].discard((i, j))
+
+    def compact(self):
+        """ Drops stale entries from the heap (keeps memory proportional to the number of pairs) """
+        self.heap = [e for e in self.heap if self.stamps.get((-e[1], -e[2])) == e[3]]
+        heapify(self.heap)
+
+    def peek(self):
+        """ Returns the best swap (value, i, j) without removing it (None if there are no swaps) """
+        while True:
+            while self.heap:
+                value, i, j, stamp = self.heap[0]
+                if self.stamps.get((-i, -j)) == stamp:
+                    return -value, -i, -j
+                heappop(self.heap)
+            if not self.dropped:
+                return None
+            # the queue has run dry, rescore the swaps that were dropped
+            dropped, self.dropped = self.dropped, set()
+            self.scan(a for a in dropped if a in self.groups)
+
+    def pop(self):
+        best = self.peek()
+        if best is not None:
+            heappop(self.heap)
+            self.discard(best[1], best[2])
+        return best
+
+    def update_unhappy(self, G):
+        for S in G.students:
+            if G.contribution(S) < -162:
+                self.unhappy.add(S.id)
+            else:
+                self.unhappy.discard(S.id)
+
+    def neighborhood(self, a):
+        """
+        Returns the set of pairs (i, j) with i < j and a one of i or j for which the swap moves a into a group
+        containing one of its partners, or moves the other student into a group containing one of its partners,
+        or one of them has an unsatisfied requirement
+        """
+        G = self.groups[a]
+        if a in self.unhappy:
+            others = set(self.groups)
+        else:
+            others = set(self.unhappy)
+        for c in self.students[a].partners:
+            if c in self.groups:
+                others.update(S.id for S in self.groups[c].students)
+        for S in G.students:
+            others.update(self.wanted.get(S.id, ()))
+        others.difference_update(S.id for S in G.students)
+        return {(a, b) if a < b else (b, a) for b in others if b in self.groups}
+
+    def update(self, groups, removed=()):
+        """ Rescores the swaps involving members of the specified groups (after they changed) and drops the swaps of removed students """
+        removed = set(removed)
+        if removed:
+            for i, j in [p for p in self.stamps if p[0] in removed or p[1] in removed]:
+                self.discard(i, j)
+            self.dropped -= removed
+            if self.granular:
+                self.unhappy -= removed
+        for a, b in self.affected(*groups):
+            self.push(a, b, self.groups[a].evaluate_swap(a, b, self.groups[b]))
+
+    def affected(self, *groups):
+        """ Returns the set of pairs (a, b) with a < b and a or b a member of one of the specified groups """
+        pairs = set()
+        if self.granular:
+            # swaps that have left the neighborhood are dropped, those that remain or have entered it are returned
+            for G in groups:
+                self.update_unhappy(G)
+            for G in groups:
+                for S in G.students:
+                    current = self.neighborhood(S.id)
+                    for i, j in self.pairs[S.id] - current:
+                        self.discard(i, j)
+                    pairs |= current
+            return pairs
+        for G in groups:
+            for S in G.students:
+                a = S.id
+                for b in self.groups:
+                    if a < b:
+                        pairs.add((a, b))
+                    elif b < a:
+                        pairs.add((b, a))
+        return pairs
+
 def evaluate_swaps(groups):
-    improvements = [(groups[i].evaluate_swap(i, j, groups[j]), i, j) for i in groups for j in groups if i < j]
-    improvements.sort(reverse=True)
-    return improvements
+    return SwapQueue(groups)
 
-def run_swaps(to_match, groups, improvements):
-    while improvements and improvements[0][0] > 0:
-        # improvements is sorted so that the best swap is first.
-        changed = []
-        # execute_swap swaps the first entry of improvements, removing all affected values from improvements and inserting them into change, then returns the largest changed value.
-        execute_swap(to_match, groups, improvements, changed)
-        improvements.extend(changed)
-        improvements.sort(reverse=True)
-
-def execute_swap(to_match, groups, improvements, changed):
-    # Execute the swap with highest value, which is the first entry in the improvements list
-    value, i, j = improvements.pop(0)
+class TimeBudget(object):
+    """
+    Wall-clock time limit for matching a class, which expires after the specified number of seconds or at the
+    specified deadline (a time.time() value), whichever comes first (never if neither is specified).
+    Once it has expired the optimizer stops making swaps and keeps the best assignment found so far.
+    """
+    def __init__(self, seconds=None, deadline=None):
+        if seconds is not None:
+            deadline = time.time() + seconds if deadline is None else min(deadline, time.time() + seconds)
+        self.deadline = deadline
+        self.rounds = 0 # number of swaps executed
+        self.stopped = False # set when the optimizer stops because the budget has expired
+        self.gap = None # value of the best remaining swap when the optimizer stopped (if known)
+
+    def expired(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.stopped = True
+        return self.stopped
+
+def run_swaps(to_match, groups, improvements, budget=None):
+    while True:
+        best = improvements.peek()
+        if best is None or best[0] <= 0:
+            break
+        if budget is not None:
+            if budget.expired():
+                budget.gap = best[0]
+                break
+            budget.rounds += 1
+        execute_swap(to_match, groups, improvements)
+
+def execute_swap(to_match, groups, improvements):
+    # Execute the swap with highest value, which is the top of the improvements queue
+    value, i, j = improvements.pop()
     # First change the actual groups (this will update these groups indexed under other ids)
     Gj = groups[i].swap(i, to_match[j])
     Gi = groups[j].swap(j, to_match[i])
     # Now change the pointers from i and j
     groups[i] = Gi
     groups[j] = Gj
+    # Swapping back undoes the swap we just made
+    improvements.push(i, j, -value)
     # Now update values of every swap containing one of the members of one of these groups
-    changed.append((-value, i, j))
-    ctr = 0
     biggest = 0
-    while ctr < len(improvements):
-        old, a, b = improvements[ctr]
-        if groups[a] is Gi or groups[a] is Gj or groups[b] is Gi or groups[b] is Gj:
-            del improvements[ctr]
-            # Swap value is symmetric
-            new = groups[a].evaluate_swap(a, b, groups[b])
-            if new > biggest:
-                biggest = new
-            changed.append((new, a, b))
-        else:
-            ctr += 1
+    for a, b in improvements.affected(Gi, Gj):
+        if (a, b) == (i, j):
+            continue
+        # Swap value is symmetric
+        new = groups[a].evaluate_swap(a, b, groups[b])
+        if new > biggest:
+            biggest = new
+        improvements.push(a, b, new)
     return biggest
 
-def refine_groups(to_match, groups):
+# maximum number of rounds of splitting groups in refine_groups
+REFINE_ROUNDS = 10
+
+def refine_groups(to_match, groups, budget=None, improvements=None, vlog=null_logger()):
+    """
+    Splits groups with too little time in common, then removes the students whose requirements are not satisfied,
+    making swaps after each round of changes.  Returns the list of kerbs of the students removed.
+    If the SwapQueue used to form the groups is specified, only the swaps involving groups that changed are rescored.
+    """
+    if improvements is None:
+        improvements = evaluate_swaps(groups)
     # Check the groups to see if there are issues that can be resolved by changing group size
-    G = set(groups.values())
-    rerun = False
-    for group in G:
-        n = len(group)
-        if n >= 9 and group.schedule_overlap() < 3:
-            rerun = True
-            # split in thirds
-            L = [Group(group.students[:n//3]), Group(group.students[n//3:(2*n)//3:]), Group(group.students[(2*n)//3:])]
-            for A in L:
-                for S in A.students:
-                    groups[S.id] = A
-        elif (n in [4,5] and group.schedule_overlap() < 2 or
-            n > 5 and group.schedule_overlap() < 3):
-            rerun = True
-            # split in half
-            L = [Group(group.students[:n//2]), Group(group.students[n//2:])]
+    for rounds in range(1, REFINE_ROUNDS + 1):
+        start = time.time()
+        changed = []
+        for group in set(groups.values()):
+            n = len(group)
+            if n >= 9 and group.schedule_overlap() < 3:
+                # split in thirds
+                L = [Group(group.students[:n//3]), Group(group.students[n//3:(2*n)//3:]), Group(group.students[(2*n)//3:])]
+            elif (n in [4,5] and group.schedule_overlap() < 2 or
+                n > 5 and group.schedule_overlap() < 3):
+                # split in half
+                L = [Group(group.students[:n//2]), Group(group.students[n//2:])]
+            else:
+                continue
             for A in L:
                 for S in A.students:
                     groups[S.id] = A
-    if rerun:
-        improvements = evaluate_swaps(groups)
-        run_swaps(to_match, groups, improvements)
-        return refine_groups(to_match, groups)
-    else:
-        # Now check for violated requirements
-        rerun = True
-        unsatisfied = []
-        for group in G:
-            # Failed matching based on student requirements; throw them out of the pool
-            unsat = [S for S in group.students if group.contribution(S) < -162]
-            if unsat:
-                rerun = True
-                sat = [S for S in group.students if S not in unsat]
-                if len(sat) <= 1:
-                    # give up on this group, we will try to match its former members after all groups have been formed
-                    unsat = [S for S in group.students]
-                    sat = []
-                else:
-                    new_group = Group(sat)
-                    for S in sat:
-                        groups[S.id] = new_group
-                for U in unsat:
-                    del groups[U.id]
-                unsatisfied .extend([U.kerb for U in unsat])
-        if rerun:
-            improvements = evaluate_swaps(groups)
-            run_swaps(to_match, groups, improvements)
-        return unsatisfied
-
-def match_all(rematch=False, forcelive=False, preview=False, vlog=null_logger()):
+            changed += L
+        if not changed:
+            break
+        if budget is None or not budget.expired():
+            improvements.update(changed)
+            run_swaps(to_match, groups, improvements, budget)
+        vlog.debug("Refinement round %d split groups into %d groups in %.3fs" % (rounds, len(changed), time.time() - start))
+    # Now check for violated requirements
+    start = time.time()
+    unsatisfied, removed, changed = [], [], []
+    for group in set(groups.values()):
+        # Failed matching based on student requirements; throw them out of the pool
+        unsat = [S for S in group.students if group.contribution(S) < -162]
+        if unsat:
+            sat = [S for S in group.students if S not in unsat]
+            if len(sat) <= 1:
+                # give up on this group, we will try to match its former members after all groups have been formed
+                unsat = [S for S in group.students]
+                sat = []
+            else:
+                new_group = Group(sat)
+                for S in sat:
+                    groups[S.id] = new_group
+                changed.append(new_group)
+            for U in unsat:
+                del groups[U.id]
+            removed += [U.id for U in unsat]
+            unsatisfied .extend([U.kerb for U in unsat])
+    if budget is None or not budget.expired():
+        improvements.update(changed, removed)
+        run_swaps(to_match, groups, improvements, budget)
+    vlog.debug("Refinement removed %d students with unsatisfied requirements in %.3fs" % (len(unsatisfied), time.time() - start))
+    return unsatisfied
+
+# in pools with at least this many students swaps are restricted to a granular neighborhood of PARTNERS partners per student
+GRANULAR_THRESHOLD = 100
+PARTNERS = 20
+
+# cluster_groups partitions pools into clusters of about CLUSTER_SIZE students before matching
+CLUSTER_SIZE = 60
+
+def cluster_students(students, size=CLUSTER_SIZE, iterations=3):
+    """
+    Partitions a list of students into clusters of roughly equal size (about size) whose members have similar schedules,
+    using k-medoids with similarity given by the number of hours two students have in common.
+    Returns a list of lists of students.
+    """
+    k = max(1, round(len(students) / size))
+    if k == 1:
+        return [students]
+    capacity = ceil(len(students) / k)
+    students = sorted(students, key=lambda S: S.id)
+    def common(S, T):
+        return (S.hours.bits & T.hours.bits).bit_count()
+    # farthest-first initialization: start with the most available student, then repeatedly add the student with
+    # the fewest hours in common with the closest medoid
+    medoids = [max(students, key=lambda S: len(S.hours))]
+    closest = [common(S, medoids[0]) for S in students]
+    while len(medoids) < k:
+        n = min(range(len(students)), key=lambda n: closest[n])
+        medoids.append(students[n])
+        closest = [max(c, common(S, students[n])) for c, S in zip(closest, students)]
+    for _ in range(iterations):
+        # balanced assignment: students with the strongest preference for one medoid over the others choose first
+        similarity = [[common(S, M) for M in medoids] for S in students]
+        def preference(n):
+            best = sorted(similarity[n], reverse=True)
+            return best[0] - best[1]
+        clusters = [[] for M in medoids]
+        for n in sorted(range(len(students)), key=preference, reverse=True):
+            for m in sorted(range(k), key=lambda m: -similarity[n][m]):
+                if len(clusters[m]) < capacity:
+                    clusters[m].append(students[n])
+                    break
+        # the new medoid of each cluster is the member with the most hours in common with the other members
+        medoids = [max(C, key=lambda S: sum(common(S, T) for T in C)) for C in clusters]
+    return [C for C in clusters if C]
+
+def refine_across_clusters(to_match, groups, budget=None):
+    """
+    Improves groups formed in separate clusters by making swaps among the members of groups that have a member with a
+    negative contribution or have less than 4 hours in common (groups that are fine within their cluster are left alone).
+    """
+    weak = {i: G for i, G in groups.items() if G.schedule_overlap() < 4 or any(G.contribution(S) < 0 for S in G.students)}
+    if len({id(G) for G in weak.values()}) < 2:
+        return
+    improvements = evaluate_swaps(weak)
+    run_swaps(to_match, weak, improvements, budget)
+    groups.update(weak)
+
+def cluster_groups(to_match, budget=None, vlog=null_logger()):
+    """
+    Creates groups for a large dictionary of students keyed by id by partitioning them into clusters with similar
+    schedules and matching each cluster separately (so the swap search is quadratic in the size of the clusters rather
+    than the pool), then making swaps among the weak groups of all the clusters and refining the merged groups as in
+    assign_groups.  Returns the same as assign_groups.
+
+    This engine is only used when it is requested (see engines): on generated pools of 200 to 400 students it is
+    several times faster than assign_groups, but its scores are not consistently as good.
+    """
+    clusters = cluster_students(list(to_match.values()))
+    vlog.info("Split %d students into %d clusters of sizes %s" % (len(to_match), len(clusters), [len(C) for C in clusters]))
+    groups, unmatched = {}, []
+    for C in clusters:
+        G, U = assign_groups({S.id: S for S in C}, budget, vlog)
+        groups.update(G)
+        unmatched += U
+    refine_across_clusters(to_match, groups, budget)
+    # swaps across clusters can leave groups that need to be split or students whose requirements are broken
+    unmatched += refine_groups(to_match, groups, budget, vlog=vlog)
+    return groups, unmatched
+
+def default_engine(to_match, budget=None, vlog=null_logger()):
+    """ Matches pools using assign_groups (the other engines are only used when requested, see engines) """
+    return assign_groups(to_match, budget, vlog)
+
+def match_all(rematch=False, forcelive=False, preview=False, vlog=null_logger(), workers=1, time_limit=None, class_time_limit=None, engine=default_engine):
     """
     Returns a dictionary keyed by class_id with three attributes: 'groups', 'unmatched_only', 'unmatched_other'
+
+    Classes are matched independently, if workers > 1 they are matched in parallel using up to this many
+    processes (workers=0 uses one process per cpu).  Log messages for each class are written to vlog in order.
+
+    If time_limit (for the whole run) or class_time_limit (for each class) is specified (in seconds), the
+    optimizer stops improving a class once its time is up and uses the best groups found so far.
+
+    Groups are created using the specified matching engine (see engines).
     """
     db = getdb(forcelive)
     vlog.info("Using %s database%s"%("live" if db_islive(db) else "test", " in preview mode" if preview else ""))
@@ -210,27 +557,73 @@ def match_all(rematch=False, forcelive=False, preview=False, vlog=null_logger())
                 return {}
         query['match_dates'] = {'$contains': today}
     results = {}
-    # TODO make classes search only return classes with students of status 2 or 5 (requires exists join, add to dbwrapper)
-    for c in db.classes.search(query, ["id", "class_name", "class_number"]):
-        if not preview and not rematch:
-            db.classlist.update({'class_id': c['id'], 'status': 2}, {'status': 5, 'status_timestamp': now},resort=False)
-        n = len(list(db.classlist.search({'class_id': c['id'], 'status': 2 if preview else 5},projection='id')))
-        if n:
+    deadline = None if time_limit is None else time.time() + time_limit
+    classes = list(db.classes.search(query, ["id", "class_name", "class_number"]))
+    if not preview and not rematch and classes:
+        db.classlist.update({'class_id': {'$in': [c['id'] for c in classes]}, 'status': 2}, {'status': 5, 'status_timestamp': now},resort=False)
+        # students being matched can't join groups, so cached copies of their data must be reloaded
+        for c in classes:
+            bump_class_version(c['id'])
+        reset_class_stats([c['id'] for c in classes])
+    snapshot = load_pools([c['id'] for c in classes], preview)
+    classes = [(c, len(snapshot[c['id']])) for c in classes if snapshot.get(c['id'])]
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(classes) <= 1:
+        for c, n in classes:
             vlog.info("Matching %d students in %s %s" % (n, c['class_number'], c['class_name']))
-            groups, only, other = matches(c, preview, vlog)
+            groups, only, other = match_pool(c, snapshot[c['id']], vlog, TimeBudget(class_time_limit, deadline), engine)
+            results[c['id']] = {'groups': groups, 'unmatched_only': only, 'unmatched_other': other}
+        return results
+    # fork so that workers inherit the loaded modules rather than reimporting (and reconnecting to) everything
+    with ProcessPoolExecutor(max_workers=min(workers, len(classes)), mp_context=get_context("fork")) as executor:
+        # the snapshot was loaded above so worker processes never touch the database
+        futures = [executor.submit(_match_pool_recorded, c, snapshot[c['id']], class_time_limit, deadline, engine) for c, n in classes]
+        for (c, n), future in zip(classes, futures):
+            vlog.info("Matching %d students in %s %s" % (n, c['class_number'], c['class_name']))
+            (groups, only, other), log = future.result()
+            log.replay(vlog)
             results[c['id']] = {'groups': groups, 'unmatched_only': only, 'unmatched_other': other}
     return results
 
-def matches(clsrec, preview=False, vlog=null_logger()):
+class LogRecorder(object):
+    """ Records log messages (e.g. in a worker process) so they can be replayed to a logger later """
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, msg, *args):
+        self.records.append((level, msg, args))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def replay(self, vlog):
+        for level, msg, args in self.records:
+            vlog.log(level, msg, *args)
+
+def _match_pool_recorded(clsrec, pool, class_time_limit=None, deadline=None, engine=default_engine):
+    log = LogRecorder()
+    # the class time limit starts when a worker picks up the class
+    return match_pool(clsrec, pool, log, TimeBudget(class_time_limit, deadline), engine=engine), log
+
+def load_pools(class_ids, preview=False):
     """
-    Creates groups for all classes in a given year and term.
-    Returns three lists: a list of groups, a list of unmatched kerbs of one students in a pool,
-    and a list of other unmatched students
+    Returns a dictionary keyed by class_id whose values are lists of triples (properties, preferences, strengths)
+    for the students to be matched in each class (plain data that can be passed to match_pool in another process).
+    Classes with no students to be matched are omitted.  Uses a single query for all the classes.
     """
-    db = getdb()
-    student_data = {rec["id"]: {key: rec.get(key) for key in student_properties} for rec in db.students.search(projection=3)}
-    clsid = clsrec["id"]
-    to_match = {}
+    pools = defaultdict(list)
+    if not class_ids:
+        return pools
     # Status:
     # 0 = unchosen
     # 1 = in group
@@ -238,10 +631,45 @@ def matches(clsrec, preview=False, vlog=null_logger()):
     # 3 = requested match
     # 4 = emailed people
     # 5 = to be matched (2 => 5 at midnight on match date, prevents students in pool from doing anything while we match)
-    for rec in db.classlist.search({"class_id": clsid, "status": 2 if preview else 5}, ["student_id", "preferences", "strengths", "properties"]):
+    for rec in students_in_pools(class_ids, 2 if preview else 5):
         properties = dict(rec["properties"])
-        properties.update(student_data[rec["student_id"]])
-        to_match[rec["student_id"]] = Student(properties, rec["preferences"], rec["strengths"])
+        properties.update({key: rec[key] for key in student_properties})
+        pools[rec["class_id"]].append((properties, rec["preferences"], rec["strengths"]))
+    return pools
+
+def load_pool(clsrec, preview=False):
+    """ Returns the list of triples (properties, preferences, strengths) for the students to be matched in a class """
+    return load_pools([clsrec["id"]], preview).get(clsrec["id"], [])
+
+def matches(clsrec, preview=False, vlog=null_logger()):
+    """
+    Creates groups for all classes in a given year and term.
+    Returns three lists: a list of groups, a list of unmatched kerbs of one students in a pool,
+    and a list of other unmatched students
+    """
+    return match_pool(clsrec, load_pool(clsrec, preview), vlog)
+
+def match_pool(clsrec, pool, vlog=null_logger(), budget=None, engine=default_engine):
+    """
+    Creates groups for the class clsrec from a list of (properties, preferences, strengths) returned by load_pool.
+    Returns the same three lists as matches (this function does not access the database).
+    If a TimeBudget is specified, the groups are the best found before it expired.
+    Pools of 4 or more students are matched by the specified engine (a function or one of the names in engines).
+    """
+    if isinstance(engine, str):
+        engine = engines[engine]
+    to_match = {}
+    for properties, preferences, strengths in pool:
+        to_match[properties["id"]] = Student(properties, preferences, strengths)
+    # Precompute the pairwise data used to score groups
+    pairs = PairTable(list(to_match.values()))
+    if len(to_match) >= GRANULAR_THRESHOLD:
+        # In large pools we only consider swaps that bring students together with one of their likely partners
+        pairs.set_partners(list(to_match.values()), PARTNERS)
+    # Scores of the groups we consider are cached for the duration of the run
+    scores = ScoreCache()
+    for S in to_match.values():
+        S.scores = scores
     # We handle small cases, where the matches are determined, first
     N = len(to_match)
     # Should fix this to use existing groups
@@ -259,58 +687,79 @@ def matches(clsrec, preview=False, vlog=null_logger()):
         for S in G.students:
             groups[S.id] = G
         # Might violate a requirement
-        unmatched = refine_groups(to_match, groups)
+        unmatched = refine_groups(to_match, groups, budget, vlog=vlog)
     else:
-        # We first need to determine which size groups to create
-        for limit in [9, 5, 4, 3, 2]:
-            for threshold in range(2,6):
-                sizes = defaultdict(list) # keys 2, 3, 3.5 (3 or 4), 4, 5 (5-8), 9 (9+), 0 (flexible)
-                for i, student in to_match.items():
-                    best, priority = student.preferences.get("size", (0, 0))
-                    best = 0 if best == "3.5" else int(best)    # 3.5 = 3 or 4 is our default, so treat as flexible
-                    if priority < threshold or limit == 2:
-                        # If we can't succeed using groups of only 2 and 3, we make everyone flexible.
-                        best = 0
-                    elif best > limit:
-                        best = limit
-                    sizes[best].append(i)
-                flex = 0
-                if len(sizes[2]) % 2:
-                    # odd number of people wanting pairs
-                    flex += 1
-                if len(sizes[3]) in [1,2,5]:
-                    flex += 3 - (len(sizes[3]) % 3)
-                if len(sizes[4]) in [1,2,3,7]:
-                    flex += 4 - (len(sizes[4]) % 4)
-                if len(sizes[5]) in [1,2,3,4,9]:
-                    flex += 5 - (len(sizes[5]) % 5)
-                if 0 < len(sizes[9]) < 9:
-                    flex += 9 - (len(sizes[9]) % 9)
-                if flex <= len(sizes[0]):
-                    # Have enough flexible students
-                    break
-            else:
-                # No arrangement will satisfy everyone's requirements
-                # We prohibit groups of 9+ then 5+ since these are harder to create.
-                # If that's still not enough, we make everyone flexible.
-                continue
-            break
-        # Now there are enough students who are flexible on their group size that we can create groups.
-        #print(limit, threshold, sizes, N, len(to_match))
-        groups = initial_assign(to_match, sizes)
-        #print(groups)
-        improvements = evaluate_swaps(groups)
-        run_swaps(to_match, groups, improvements)
-        unmatched = refine_groups(to_match, groups)
+        groups, unmatched = engine(to_match, budget, vlog)
+    if budget is not None and budget.stopped:
+        gap = "" if budget.gap is None else ", best remaining swap would improve the score by %s" % budget.gap
+        vlog.warning("Time budget for %s expired after %d swap rounds%s" % (clsrec["class_number"], budget.rounds, gap))
     # Print warnings for groups with low compatibility and for non-satisfied requirements
     vlog.info("%s assignments complete" % clsrec["class_number"])
     for grp in set(groups.values()):
         grp.print_warnings(vlog)
     if unmatched:
         vlog.warning("Unmatched students %s in %s" % (unmatched, clsrec["class_number"]))
+    vlog.debug("Score cache for %s: %d hits, %d misses, %d entries" % (clsrec["class_number"], scores.hits, scores.misses, len(scores)))
     gset = set(groups.values())
     return [[S.kerb for S in group.students] for group in gset], [], unmatched
 
+def assign_groups(to_match, budget=None, vlog=null_logger()):
+    """
+    Creates groups for a dictionary of at least 4 students keyed by id, returns a dictionary of groups keyed by
+    student id and a list of kerbs of students who could not be matched (see refine_groups).
+    """
+    # We first need to determine which size groups to create
+    for limit in [9, 5, 4, 3, 2]:
+        for threshold in range(2,6):
+            sizes = defaultdict(list) # keys 2, 3, 3.5 (3 or 4), 4, 5 (5-8), 9 (9+), 0 (flexible)
+            for i, student in to_match.items():
+                best, priority = student.preferences.get("size", (0, 0))
+                best = 0 if best == "3.5" else int(best)    # 3.5 = 3 or 4 is our default, so treat as flexible
+                if priority < threshold or limit == 2:
+                    # If we can't succeed using groups of only 2 and 3, we make everyone flexible.
+                    best = 0
+                elif best > limit:
+                    best = limit
+                sizes[best].append(i)
+            flex = 0
+            if len(sizes[2]) % 2:
+                # odd number of people wanting pairs
+                flex += 1
+            if len(sizes[3]) in [1,2,5]:
+                flex += 3 - (len(sizes[3]) % 3)
+            if len(sizes[4]) in [1,2,3,7]:
+                flex += 4 - (len(sizes[4]) % 4)
+            if len(sizes[5]) in [1,2,3,4,9]:
+                flex += 5 - (len(sizes[5]) % 5)
+            if 0 < len(sizes[9]) < 9:
+                flex += 9 - (len(sizes[9]) % 9)
+            if flex <= len(sizes[0]):
+                # Have enough flexible students
+                break
+        else:
+            # No arrangement will satisfy everyone's requirements
+            # We prohibit groups of 9+ then 5+ since these are harder to create.
+            # If that's still not enough, we make everyone flexible.
+            continue
+        break
+    # Now there are enough students who are flexible on their group size that we can create groups.
+    #print(limit, threshold, sizes, N, len(to_match))
+    groups = initial_assign(to_match, sizes)
+    #print(groups)
+    improvements = evaluate_swaps(groups)
+    run_swaps(to_match, groups, improvements, budget)
+    unmatched = refine_groups(to_match, groups, budget, improvements, vlog)
+    return groups, unmatched
+
+# Matching engines take a dictionary of at least 4 students keyed by id (with their PairTable and ScoreCache set up by
+# match_pool), an optional TimeBudget, and a logger, and return a dictionary of groups
+# keyed by student id and a list of kerbs of unmatched students
+engines = {
+    "default": default_engine,
+    "swaps": assign_groups,
+    "clusters": cluster_groups,
+}
+
 # TODO: Our lives would be simpler if the size pref values where 2,4,8,16 rather than 2,3,5,9 (with the same meaning)
 def size_pref_from_size(size):
     if size <= 2:
@@ -332,15 +781,18 @@ def group_member (db, class_id, kerb, g=None):
         return None
     properties = dict(rec["properties"])
     properties.update(student_data)
+    return _group_member(properties, rec['preferences'], rec['strengths'], g)
+
+def _group_member(properties, preferences, strengths, g=None):
     if g:
         for k in styles + ['size']:
             if k in g['preferences']:
-                if k not in rec['preferences']:
-                    rec['strengths'][k] = 3
-                elif rec['preferences'][k] != g['preferences'][k]:
-                    rec['strengths'][k] = 1 # if student actually preferred something other than the group preference, make the strength weak
-                rec['preferences'][k] = g['preferences'][k]
-    return Student(properties, rec['preferences'], rec['strengths'])
+                if k not in preferences:
+                    strengths[k] = 3
+                elif preferences[k] != g['preferences'][k]:
+                    strengths[k] = 1 # if student actually preferred something other than the group preference, make the strength weak
+                preferences[k] = g['preferences'][k]
+    return Student(properties, preferences, strengths)
 
 def rank_groups (class_id, kerb):
     """
@@ -355,21 +807,33 @@ def rank_groups (class_id, kerb):
     with whatever the group preferences if specified, since they presumably agreed to them (but we adjust the strength based on
     the students preferences for the class).  In addition, if the group has no preferred size we will make it 1 larger than it is now
     (this is needed to make sure it conflicts with prospective students who want a different size).
+
+    The groups and their members are loaded with a single query (open_groups_in_class) that applies the filters above.
+    Only groups returned by GroupIndex.candidates are ranked (groups with no hours in common with the student, or with
+    a required preference that adding the student would break, are omitted).
     """
 
     db = getdb()
     res = []
-    G = [g for g in db.groups.search({'class_id': class_id, 'visibility': {'$gte': 1}, 'request_id': None}, projection=['id','group_name','visibility','size','max', 'preferences']) if
-         g['max'] is None or g['size'] < g['max']] # TODO write a SQL query to handle the size filter
-    G = [g for g in G if not db.grouplistleft.lucky({'group_id': g['id'], 'kerb': kerb}, projection='id')]
     student = group_member(db, class_id, kerb)
-    for g in G:
-        if not 'size' in g['preferences']:
-            g['preferences']['size'] = size_pref_from_size(g['size']+1) # default is to prefer to be 1 larger than we are
+    G = {}
+    for r in open_groups_in_class(class_id, kerb):
+        g = G.get(r['group_id'])
+        if g is None:
+            g = G[r['group_id']] = {'id': r['group_id'], 'visibility': r['visibility'], 'size': r['size'], 'preferences': r['group_preferences'], 'students': []}
+            if not 'size' in g['preferences']:
+                g['preferences']['size'] = size_pref_from_size(g['size']+1) # default is to prefer to be 1 larger than we are
         # We expect the student is not already in a group in this class, but we may as well handle this case
-        students = [group_member(db, class_id, k, g) for k in db.grouplist.search({'group_id': g['id']}, projection='kerb') if k != kerb]
-        if not students:
+        if r['kerb'] == kerb:
             continue
+        properties = dict(r["properties"])
+        properties.update({key: r[key] for key in student_properties})
+        g['students'].append(_group_member(properties, r['preferences'], r['strengths'], g))
+    G = [g for g in G.values() if g['students']]
+    index = GroupIndex([g['students'] for g in G])
+    for n in index.candidates(student):
+        g = G[n]
+        students = g['students']
         if len(students) == 1: # compatibility of a 1-student group is not really well-defined, treat as 0
             delta = Group(students + [student]).compatibility()
         else:
@@ -377,17 +841,260 @@ def rank_groups (class_id, kerb):
         res.append((g['id'], g['visibility'], delta))
     return sorted(res, key=lambda x: x[2], reverse=True)
 
+class GroupIndex(object):
+    """
+    Index of a list of groups (each a list of instances of Student) used to find candidate groups for a student:
+    for each hour, the bitset of groups whose members are all available at that hour, and for each group a signature
+    of the required (strength 5) preferences of its members that a new member could break.
+    """
+    def __init__(self, groups):
+        self.groups = groups
+        self.hours = [0] * 168
+        # for each group, the set of compiled requirements (k, rule, code) that a new member's codes must satisfy (see Student.codes)
+        self.signatures = []
+        # for each group, the list of codes of its members for each quality index (used for the new member's requirements)
+        self.codes = []
+        # for each group, True if adding a member would break some member's required size
+        self.full = []
+        for n, students in enumerate(groups):
+            for h in Availability.intersection(S.hours for S in students):
+                self.hours[h] |= 1 << n
+            signature = set()
+            for T in students:
+                for q, (mode, reward, penalty) in zip(T.scored, T.scoring):
+                    # adding a member can't break a requirement for at least one match, or a requirement for no mismatches that is already broken
+                    if not penalty or mode == SOME_MATCH:
+                        continue
+                    if mode == NO_MISMATCH and any(T.check(q, U) is False for U in students if U.id != T.id):
+                        continue
+                    k = quality_index[q]
+                    if T.codes[k] is not None:
+                        signature.add((k, T.rules[k], T.codes[k]))
+            self.signatures.append(signature)
+            self.codes.append([[T.codes[k] for T in students if T.codes[k] is not None] for k in range(len(quality_index))])
+            n = len(students)
+            self.full.append(any(T.size_score(n+1) <= -10**6 < T.size_score(n) for T in students))
+
+    def candidates(self, student):
+        """ Returns the list of indexes of groups that have hours in common with student and whose requirements student would not break (in order) """
+        bits = 0
+        for h in student.hours:
+            bits |= self.hours[h]
+        res = []
+        n = 0
+        while bits:
+            if bits & 1 and self.compatible(n, student):
+                res.append(n)
+            bits >>= 1
+            n += 1
+        return res
+
+    def compatible(self, n, student):
+        if self.full[n] or student.size_score(len(self.groups[n])+1) <= -10**6:
+            return False
+        for k, rule, code in self.signatures[n]:
+            b = student.codes[k]
+            if b is not None and not _compare(rule, code, b):
+                return False
+        for q, (mode, reward, penalty) in zip(student.scored, student.scoring):
+            if not penalty:
+                continue
+            k = quality_index[q]
+            a = student.codes[k]
+            if a is None:
+                continue
+            checks = [_compare(student.rules[k], a, b) for b in self.codes[n][k]]
+            if (mode == SOME_MATCH and not any(checks)) or (mode != SOME_MATCH and not all(checks)):
+                return False
+        return True
+
+# results of rank_groups keyed by (live, class_id, student_id), values are pairs (version, ranking) where version is the class version
+_ranked_groups_cache = OrderedDict()
+RANKED_GROUPS_CACHE_SIZE = 8192
+
+def ranked_groups (class_id, student_id, kerb, version):
+    """
+    Returns rank_groups(class_id, kerb), reusing the result of a previous call if the version has not changed since.
+    The version should combine the version of the class, which must be bumped (see dbwrapper.bump_class_version) whenever
+    a group in the class is created, edited, joined, or left or a member of a group changes their profile, and the version of
+    the student (see dbwrapper.bump_student_version).  Results are not cached if version is None.
+    """
+    if version is None:
+        return rank_groups(class_id, kerb)
+    key = (db_islive(getdb()), class_id, student_id)
+    entry = _ranked_groups_cache.get(key)
+    if entry is not None and entry[0] == version:
+        _ranked_groups_cache.move_to_end(key)
+        return entry[1]
+    ranking = rank_groups(class_id, kerb)
+    _ranked_groups_cache[key] = (version, ranking)
+    _ranked_groups_cache.move_to_end(key)
+    if len(_ranked_groups_cache) > RANKED_GROUPS_CACHE_SIZE:
+        _ranked_groups_cache.popitem(last=False)
+    return ranking
+
+def overlap_score(overlap):
+    """ Score based on the number of hours in which every member of a group is available """
+    if overlap < 4:
+        return -20**(4-overlap)
+    elif overlap < 20:
+        return 5*(overlap - 4)
+    else:
+        return 80 + 5 * floor(sqrt(overlap - 20))
+
+def leave_one_out_score(overlaps):
+    """ Average of the overlaps of the subgroups obtained by leaving out one member (0 for groups of size less than 3) """
+    n = len(overlaps)
+    if n < 3:
+        return 0
+    return round(sum(overlaps) / n)
+
+class ScoreCache(object):
+    """
+    Cache of group compatibility scores for a single matching run, keyed by the sorted tuple of member ids
+    (see Group.key).  Once there are more than maxsize entries, the least recently used entry is evicted.
+    """
+    def __init__(self, maxsize=2**17):
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key):
+        """ Returns the cached score for key, or None if there is none """
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.values.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.values.move_to_end(key)
+        if len(self.values) > self.maxsize:
+            self.values.popitem(last=False)
+
+class PairTable(object):
+    """
+    Pairwise data for the students in a pool that does not change while the pool is being matched:
+    the number of hours each pair has in common, and the value of Student.check for each pair and quality.
+    Rows are stored as bytes; check rows only depend on a few attributes of the first student so they are
+    computed once for each distinct signature and shared.
+    """
+    codes = (None, False, True)
+
+    def __init__(self, students):
+        bits = [S.hours.bits for S in students]
+        self.overlap = [bytes((b & c).bit_count() for c in bits) for b in bits]
+        self.rows = {}
+        for q in pair_qualities:
+            rows, shared = [], {}
+            for S in students:
+                sig = self.signature(q, S)
+                if sig not in shared:
+                    if q != "blocked_kerbs" and None in sig:
+                        # Student.score never checks affinities the student has no preference about (and unknowns check as None)
+                        shared[sig] = bytes(len(students))
+                    else:
+                        shared[sig] = bytes(self.code(S._check(q, T)) for T in students)
+                rows.append(shared[sig])
+            self.rows[q] = rows
+        for n, S in enumerate(students):
+            S.pairs = self
+            S.row = n
+            S.scored_rows = [self.rows[q][n] for q in S.scored]
+
+    @staticmethod
+    def signature(quality, S):
+        if quality == "blocked_kerbs":
+            return S.blocked
+        k = quality_index[quality]
+        return (S.rules[k], S.codes[k])
+
+    @staticmethod
+    def code(c):
+        return 0 if c is None else (2 if c else 1)
+
+    def check(self, quality, S, T):
+        return self.codes[self.rows[quality][S.row][T.row]]
+
+    def set_partners(self, students, k):
+        """
+        Sets S.partners for each student S to the ids of the k students S is most likely to be grouped with:
+        students that do not violate a requirement of S or of whom S does not violate a requirement come first,
+        then students with the most hours in common with S.
+        """
+        # rows of the qualities each student treats as requirements (blocked kerbs and strength 5 preferences
+        # other than "some match" preferences, which can be satisfied by another member of the group)
+        hard = []
+        for S in students:
+            rows = [self.rows["blocked_kerbs"][S.row]]
+            for r, (mode, reward, penalty) in zip(S.scored_rows, S.scoring):
+                if penalty and mode != SOME_MATCH:
+                    rows.append(r)
+            hard.append(rows)
+        for S in students:
+            n, overlap = S.row, self.overlap[S.row]
+            def rank(T):
+                m = T.row
+                compatible = all(r[m] != 1 for r in hard[n]) and all(r[n] != 1 for r in hard[m])
+                return (compatible, overlap[m], -T.id)
+            S.partners = [T.id for T in nlargest(k, (T for T in students if T is not S), key=rank)]
+
+    def schedule_overlap(self, S, T):
+        return self.overlap[S.row][T.row]
+
 class Student(object):
+    __slots__ = ["id", "kerb", "hours", "properties", "preferences", "blocked", "codes", "rules", "scored", "scoring",
+                 "size_scores", "pairs", "row", "scored_rows", "scores", "partners"]
+
     def __init__(self, properties, preferences, strengths):
         self.id = properties["id"]
         self.kerb = properties["kerb"]
-        offset = hours_from_default(properties["timezone"])
-        hours = properties["hours"]
-        self.hours = tuple(hours[(i-offset)%168] for i in range(168))
+        self.hours = Availability.from_hours(properties["hours"], properties["timezone"])
+        # the properties and preferences dictionaries are kept for rank_groups and warnings, scoring uses the compiled features below
         self.properties = properties
         self.preferences = {}
         for k, v in preferences.items():
             self.preferences[k] = (v, strengths.get(k, 3))
+        self.blocked = frozenset(properties.get("blocked_kerbs") or [])
+        # compiled features indexed by quality_index: codes are the values compared by check (properties for affinities,
+        # preferences for styles), and rules are the comparisons this student wants (None if there is no preference)
+        self.codes, self.rules = [], []
+        for q in affinities:
+            pref = self.preferences.get(q, (None, 0))[0]
+            prop = q.replace("_affinity", "")
+            self.codes.append(_mask(properties.get(prop)) if prop == "departments" else _code(properties.get(prop)))
+            if pref is None:
+                self.rules.append(OVERLAP if prop == "departments" else None)
+            elif pref == '3':
+                self.rules.append(DIFFERENT)
+            else:
+                self.rules.append(OVERLAP if prop == "departments" else SAME)
+        for q in styles:
+            self.codes.append(_code(self.preferences.get(q, (None, 0))[0]))
+            self.rules.append(SAME)
+        # qualities (other than size) for which this student's preferences contribute to the score of a group,
+        # and how they are scored: (mode, score per match, penalty per mismatch)
+        self.scored = [q for q in affinities + styles if self.preferences.get(q, (None, 0))[0] is not None]
+        self.scoring = []
+        for q in self.scored:
+            pref, s = self.preferences[q]
+            mode = ADDITIVE if q in styles else (NO_MISMATCH if pref == '2' else SOME_MATCH)
+            self.scoring.append((mode, 3**s, 10**6 if s == 5 else 0))
+        self.size_scores = {}
+        # set by PairTable
+        self.pairs = None
+        self.row = None
+        self.scored_rows = None
+        self.partners = None
+        # set by match_pool
+        self.scores = None
 
     def __hash__(self):
         return self.id
@@ -406,6 +1113,100 @@ class Student(object):
             Gplus = Group(G.students + [self])
         return Gplus.compatibility()
 
+    def check(self, quality, T):
+        """
+        Returns True or False according to whether T is compatible with this student's preference about ``quality``,
+        or None if we don't know.  Uses the pair table for the pool if this student has one.
+        """
+        if self.pairs is not None and T.pairs is self.pairs:
+            return self.pairs.check(quality, self, T)
+        return self._check(quality, T)
+
+    def _check(self, quality, T):
+        if quality == "blocked_kerbs":
+            return not (T.kerb in self.blocked)
+        k = quality_index[quality]
+        a, b = self.codes[k], T.codes[k]
+        if a is None or b is None:
+            # If we don't know the relevant quantity for one of the students
+            # it doesn't contribute positively but also doesn't impose a
+            # penalty for mismatching
+            return None
+        return _compare(self.rules[k], a, b)
+
+    def size_score(self, n):
+        """ Contribution to the compatibility score of a group of size n from this user's size preference """
+        score = self.size_scores.get(n)
+        if score is None:
+            score = self.size_scores[n] = self._size_score(n)
+        return score
+
+    def _size_score(self, n):
+        pref, s = self.preferences.get("size", (None, 0))
+        if pref is None:
+            return 0
+        if pref == '2':
+            satisfied = (n == 2)
+            d = 0 if satisfied else max(n/2,2/n)
+        elif pref == '3':
+            satisfied = (n == 3)
+            d = 0 if satisfied else max(n/3,3/n)
+        elif pref == '3.5':
+            satisfied = (3 <= n <= 4)
+            d = 0 if satisfied else max(n/4,3/n)
+        elif pref == '4':
+            satisfied = (n == 4)
+            d = 0 if satisfied else max(n/4,4/n)
+        elif pref == '5':
+            satisfied = (5 <= n <= 8)
+            d = 0 if satisfied else max(n/8,5/n)
+        elif pref == '9':
+            satisfied = (9 <= n)
+            d = 0 if satisfied else 9/n
+        else:
+            assert False, "Invalid size preference %s, should be a string in ['2','3','3.5','4','5','9'] or none" % pref
+        if satisfied:
+            return 3**s
+        elif s == 5:
+            return -10**6
+        else:
+            return -ceil(2*d)^s
+
+    def tally(self, T, tallies, sign=1):
+        """
+        Adds T's matches and mismatches with this student's scored preferences to tallies (or subtracts them if sign=-1).
+        The tallies are a list of counts [matches, mismatches] for each quality in self.scored (flattened).
+        """
+        if self.pairs is not None and T.pairs is self.pairs:
+            j = T.row
+            for k, row in enumerate(self.scored_rows):
+                c = row[j]
+                if c == 2:
+                    tallies[2*k] += sign
+                elif c == 1:
+                    tallies[2*k+1] += sign
+            return
+        for k, quality in enumerate(self.scored):
+            c = self._check(quality, T)
+            if c:
+                tallies[2*k] += sign
+            elif c is False:
+                tallies[2*k+1] += sign
+
+    def tally_score(self, tallies, n):
+        """ Contribution to the compatibility score of a group of size n in which the other members have the specified tallies """
+        score = self.size_score(n)
+        for k, (mode, reward, penalty) in enumerate(self.scoring):
+            matches, mismatches = tallies[2*k], tallies[2*k+1]
+            if mode == ADDITIVE:
+                score += matches * reward - mismatches * penalty
+            elif (mismatches == 0) if mode == NO_MISMATCH else (matches > 0):
+                # matches the score method: preference 2 accepts unknowns, otherwise we need at least one match
+                score += reward
+            else:
+                score -= penalty
+        return score
+
     def score(self, quality, G):
         """
         Contribution to the compatibility score from this user's preferences about ``quality``.
@@ -419,39 +1220,7 @@ class Student(object):
         if isinstance(G, Student):
             G = Group([G])
         def check(T):
-            if quality in styles:
-                a, s = self.preferences.get(quality, (None, 0))
-                b, _ = T.preferences.get(quality, (None, 0))
-            elif quality in ["blocked_kerbs"] + affinities:
-                prop = quality.replace("_affinity", "")
-                a = self.properties.get(prop)
-                b = T.properties.get(prop)
-            if quality == "blocked_kerbs":
-                return not (T.properties.get("kerb") in a)
-            if a is None or b is None:
-                # If we don't know the relevant quantity for one of the students
-                # it doesn't contribute positively but also doesn't impose a
-                # penalty for mismatching
-                return None
-            #if quality == "hours":
-            #    # Time overlap below 4 hours will start producing negative scores
-            #    # One might change this measure in the following ways:
-            #    # * take account the forum (video is much more synchronous than text)
-            #    # * compare the times available for EVERYONE in the group
-            #    overlap = sum(x and y for (x,y) in zip(a,b))
-            #    if overlap < 4:
-            #        return -20**(4-overlap)
-            if quality in styles:
-                return (a == b)
-            if quality in affinities:
-                pref = self.preferences.get(quality, (None, 0))[0]
-                if pref == '3':
-                    return (a != b)
-                elif quality == "departments_affinity":
-                    return bool(set(a) & set(b))
-                elif pref is not None:
-                    return (a == b)
-            raise RuntimeError
+            return self.check(quality, T)
 
         others = [T for T in G.students if T.id != self.id]
         if quality == "blocked_kerbs":
@@ -462,32 +1231,7 @@ class Student(object):
         if pref is None:
             return 0
         if quality == "size":
-            if pref == '2':
-                satisfied = (len(G) == 2)
-                d = 0 if satisfied else max(len(G)/2,2/len(G))
-            elif pref == '3':
-                satisfied = (len(G) == 3)
-                d = 0 if satisfied else max(len(G)/3,3/len(G))
-            elif pref == '3.5':
-                satisfied = (3 <= len(G) <= 4)
-                d = 0 if satisfied else max(len(G)/4,3/len(G))
-            elif pref == '4':
-                satisfied = (len(G) == 4)
-                d = 0 if satisfied else max(len(G)/4,4/len(G))
-            elif pref == '5':
-                satisfied = (5 <= len(G) <= 8)
-                d = 0 if satisfied else max(len(G)/8,5/len(G))
-            elif pref == '9':
-                satisfied = (9 <= len(G))
-                d = 0 if satisfied else 9/len(G)
-            else:
-                assert False, "Invalid size preference %s, should be a string in ['2','3','3.5','4','5','9'] or none" % pref
-            if satisfied:
-                return 3**s
-            elif s == 5:
-                return -10**6
-            else:
-                return -ceil(2*d)^s
+            return self.size_score(len(G))
         # Affinities aren't linear
         if quality in affinities:
             if pref == '2':
@@ -520,6 +1264,10 @@ class Group(object):
     def __init__(self, students):
         """ Creates an instance of Group from a list of instances of Student (which should all be in the same class) """
         self.students = students
+        # incremental scoring state, built on demand by _build_state (None if it needs to be rebuilt)
+        self.tallies = None  # dictionary of tallies (see Student.tally) of the other members keyed by student id
+        self.terms = None  # dictionary of contributions (see Student.tally_score) keyed by student id
+        self.hour_counts = None  # per-hour counts of available members (an AvailabilityCounts), built on demand by availability
 
     def by_id(self, n):
         for S in self.students:
@@ -529,6 +1277,9 @@ class Group(object):
 
     def add(self, student):
         self.students.append(student)
+        self.tallies = None
+        if self.hour_counts is not None:
+            self.hour_counts.add(student.hours)
 
     def __len__(self):
         return len(self.students)
@@ -543,55 +1294,133 @@ class Group(object):
         students = ["%s%s" % (S, "(%s)" % (self.contribution(S)) if self.contribution(S) < 0 else "") for S in self.students]
         return "Group(size=%s, score=%s, overlap=%s) %s" % (len(self), self.compatibility(), self.schedule_overlap(), " ".join(students))
 
+    def _build_state(self):
+        if self.tallies is not None:
+            return
+        n = len(self.students)
+        self.tallies, self.terms = {}, {}
+        for S in self.students:
+            tallies = [0] * (2*len(S.scored))
+            for T in self.students:
+                if T.id != S.id:
+                    S.tally(T, tallies)
+            self.tallies[S.id] = tallies
+            self.terms[S.id] = S.tally_score(tallies, n)
+
+    def availability(self):
+        """ Returns the per-hour counts of available members (an AvailabilityCounts) """
+        if self.hour_counts is None:
+            self.hour_counts = AvailabilityCounts(S.hours for S in self.students)
+        return self.hour_counts
+
     def schedule_overlap(self):
-        hour_data = [S.hours for S in self.students]
-        return sum(all(available) for available in zip(*hour_data))
+        if len(self.students) == 2:
+            S, T = self.students
+            if S.pairs is not None and T.pairs is S.pairs:
+                return S.pairs.schedule_overlap(S, T)
+        return len(self.availability().overlap())
 
-    @lru_cache(2)
     def secondary_schedule_score(self):
-        n = len(self.students)
-        if n < 3:
+        if len(self.students) < 3:
             return 0
-        hour_data = [[S.hours for S in self.students[:i]+self.students[i+1:]] for i in range(n)]
-        return round(sum([sum(all(available) for available in zip(*hour_data[i])) for i in range(n)]) / n)
+        return leave_one_out_score(self.availability().leave_one_out(S.hours for S in self.students))
 
-    @lru_cache(2)
     def schedule_score(self):
         """
         Score based on how much overlap there is in the hours scheduled
         """
-        overlap = self.schedule_overlap()
-        if overlap < 4:
-            return -20**(4-overlap)
-        elif overlap < 20:
-            return 5*(overlap - 4)
-        else:
-            return 80 + 5 * floor(sqrt(overlap - 20))
+        return overlap_score(self.schedule_overlap())
 
-    @lru_cache(10)
     def contribution(self, student):
+        self._build_state()
+        if student.id in self.terms:
+            return self.terms[student.id]
         return sum(student.score(q, self) for q in affinities + styles + ['size'])
 
-    @lru_cache(2)
+    def key(self):
+        """ Canonical key for the set of members used by ScoreCache """
+        return tuple(sorted(S.id for S in self.students))
+
     def compatibility(self):
+        scores = self.students[0].scores if self.students else None
+        if scores is None:
+            return self._compatibility()
+        key = self.key()
+        value = scores.get(key)
+        if value is None:
+            value = scores[key] = self._compatibility()
+        return value
+
+    def _compatibility(self):
         # note that we don't want to average primary and secondary schedule scores, we want to sum them
         # averaging will potentially make a horrible primary score half as bad and we don't want to do that (especially when computing deltas)
         # this potentially favors groups of size 3 over groups of size 2 (which have no secondary score), but that's OK
+        self._build_state()
         schedule_score = self.schedule_score() if len(self.students) < 3 else (self.schedule_score() + self.secondary_schedule_score())
-        return sum(self.contribution(student) for student in self.students) + schedule_score
+        return sum(self.terms.values()) + schedule_score
+
+    def replacement_delta(self, thisid, other):
+        """
+        Returns the change in compatibility that would result from replacing the member with id thisid by other,
+        computed from the scoring state without rescoring the members whose tallies are unaffected.
+        """
+        scores = other.scores
+        if scores is not None:
+            key = tuple(sorted([S.id for S in self.students if S.id != thisid] + [other.id]))
+            value = scores.get(key)
+            if value is not None:
+                return value - self.compatibility()
+        self._build_state()
+        X = self.by_id(thisid)
+        n = len(self.students)
+        delta = -self.terms[thisid]
+        tallies = [0] * (2*len(other.scored))
+        rest = []
+        for S in self.students:
+            if S.id == thisid:
+                continue
+            rest.append(S)
+            other.tally(S, tallies)
+            revised = list(self.tallies[S.id])
+            S.tally(X, revised, -1)
+            S.tally(other, revised)
+            if revised != self.tallies[S.id]:
+                delta += S.tally_score(revised, n) - self.terms[S.id]
+        delta += other.tally_score(tallies, n)
+        hour_counts = self.availability()
+        delta += overlap_score(len(hour_counts.replaced_overlap(X.hours, other.hours))) - self.schedule_score()
+        if n >= 3:
+            overlaps = hour_counts.leave_one_out([S.hours for S in rest] + [other.hours], replaced=(X.hours, other.hours))
+            delta += leave_one_out_score(overlaps) - self.secondary_schedule_score()
+        if scores is not None:
+            scores[key] = self.compatibility() + delta
+        return delta
 
     def evaluate_swap(self, thisid, otherid, othergrp):
-        if self == othergrp:
+        # distinct groups in a matching never share members
+        if self is othergrp:
             return 0
-        revised_self = Group([S for S in self.students if S.id != thisid] + [othergrp.by_id(otherid)])
-        revised_other = Group([S for S in othergrp.students if S.id != otherid] + [self.by_id(thisid)])
-        return (revised_self.compatibility() + revised_other.compatibility()) - (self.compatibility() + othergrp.compatibility())
+        return self.replacement_delta(thisid, othergrp.by_id(otherid)) + othergrp.replacement_delta(otherid, self.by_id(thisid))
 
     def swap(self, thisid, other):
-        self.schedule_score.cache_clear()
-        self.compatibility.cache_clear()
-        self.contribution.cache_clear()
+        X = self.by_id(thisid)
         self.students = [S for S in self.students if S.id != thisid] + [other]
+        if self.tallies is not None:
+            # update the scoring state rather than rebuilding it
+            n = len(self.students)
+            del self.tallies[thisid]
+            del self.terms[thisid]
+            tallies = [0] * (2*len(other.scored))
+            for S in self.students[:-1]:
+                other.tally(S, tallies)
+                S.tally(X, self.tallies[S.id], -1)
+                S.tally(other, self.tallies[S.id])
+                self.terms[S.id] = S.tally_score(self.tallies[S.id], n)
+            self.tallies[other.id] = tallies
+            self.terms[other.id] = other.tally_score(tallies, n)
+        if self.hour_counts is not None:
+            self.hour_counts.remove(X.hours)
+            self.hour_counts.add(other.hours)
         return self
 
     def print_warnings(self, vlog):
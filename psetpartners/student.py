@@ -1,10 +1,24 @@
-import datetime
+import datetime, copy, time, json
+from collections import OrderedDict, Counter
 from . import app
 from .app import debug_mode, livesite, send_email
 from .config import Configuration
 from .people import get_kerb_data
-from .dbwrapper import getdb, students_in_classes, students_in_class, students_groups_in_class, students_in_group, count_rows
-from flask import url_for
+from .dbwrapper import (
+    getdb,
+    db_islive,
+    students_in_classes,
+    students_in_class,
+    students_groups_in_class,
+    students_in_group,
+    count_rows,
+    bump_class_version,
+    bump_student_version,
+    student_data_version,
+    claim_counts_refresh,
+    lock_class_stats,
+    )
+from flask import url_for, g as flask_g, has_request_context
 from flask_login import UserMixin, AnonymousUserMixin
 from pytz import timezone, UnknownTimeZoneError
 from .utils import (
@@ -22,7 +36,7 @@ from .utils import (
     )
 from .group import generate_group_name
 from .token import generate_timed_token
-from .match import rank_groups
+from .match import ranked_groups
 from psycodict import DelayCommit
 
 strength_options = ["no preference", "nice to have", "weakly preferred", "preferred", "strongly preferred", "required"]
@@ -461,6 +475,146 @@ def group_visibility_counts(class_number, year=current_year(), term=current_term
                 wcounts[v] = wcounts[v]+1 if v in wcounts else 1
     return vcounts, wcounts
 
+def term_counts(opts, year=current_year(), term=current_term()):
+    """ Returns a count dictionary for students and groups across all classes in the specified term (see get_counts) """
+    db = getdb();
+    counts = student_counts(students_in_classes(year=year, term=term), opts)
+    counts['classes'] = count_rows('classes', {'active':True, 'year': year, 'term': term})
+    counts['students_classes'] = count_rows('classlist', {'year': year, 'term': term})
+    counts['groups'] = count_rows('groups', {'year': year, 'term': term})
+    counts['students_groups'] = count_rows('grouplist', {'year': year, 'term': term})
+    counts['visibility'], counts['capacity'] = group_visibility_counts('', year=year, term=term)
+    counts['students_visibility'] = student_visibility_counts(db.groups.search({'year': year, 'term': term}, projection=["size", "visibility"]))
+    return counts
+
+# Term-wide counts are cached in the counts_cache table so that all workers share them.  Entries older than COUNTS_CACHE_TTL
+# seconds are still served, except to the first worker to see one, which claims it and refreshes it.
+COUNTS_CACHE_TTL = 60
+# time in seconds after which an unfinished refresh (e.g. one whose worker died) can be claimed by another worker
+COUNTS_REFRESH_TIMEOUT = 300
+
+def _refresh_term_counts(name, opts, year, term):
+    counts = term_counts(opts, year=year, term=term)
+    getdb().counts_cache.upsert({'name': name}, {'value': counts, 'timestamp': datetime.datetime.now(), 'refreshing': None})
+    return counts
+
+def cached_term_counts(opts, year=current_year(), term=current_term()):
+    """
+    Returns term_counts(opts, year, term), possibly up to COUNTS_CACHE_TTL seconds out of date (or longer while a refresh
+    is in progress).  A stale entry is refreshed by the caller that claims the refresh, other callers get the stale value.
+    """
+    db = getdb()
+    name = "%s/%s/%s" % (year, term, ",".join(sorted(opts)))
+    r = db.counts_cache.lucky({'name': name}, projection=['value', 'timestamp'])
+    if r is None:
+        return _refresh_term_counts(name, opts, year, term)
+    now = datetime.datetime.now()
+    if r['timestamp'] + datetime.timedelta(seconds=COUNTS_CACHE_TTL) < now:
+        # refresh here rather than after the response, where we would no longer know whether we are on the live site
+        if claim_counts_refresh(name, now, now - datetime.timedelta(seconds=COUNTS_REFRESH_TIMEOUT)):
+            return _refresh_term_counts(name, opts, year, term)
+    return r['value']
+
+# options whose counts are kept in the class_stats table (hours are kept separately for each timezone, see class_stats_counts)
+class_stats_options = [opt for opt in countable_options if opt != 'hours'] + ['status']
+# time in seconds after which class_stats rows are recomputed from scratch (this bounds the effect of any changes made without ClassStatsUpdate)
+CLASS_STATS_MAX_AGE = 3600
+
+def add_counts(total, delta, sign=1, prune=False):
+    """ Adds sign*delta to total (nested dictionaries of counts and lists of counts), removing nested entries that become zero """
+    for k, v in delta.items():
+        if isinstance(v, dict):
+            add_counts(total.setdefault(k, {}), v, sign, prune=True)
+        elif isinstance(v, list):
+            total[k] = [a + sign*b for a, b in zip(total.get(k, [0 for i in range(len(v))]), v)]
+        else:
+            total[k] = total.get(k, 0) + sign*v
+        if prune and not (any(total[k]) if isinstance(total[k], list) else total[k]):
+            total.pop(k)
+    return total
+
+def class_stats_counts(students, groups):
+    """
+    Returns the counts kept in class_stats for the specified students (as returned by students_in_class) and groups (with
+    visibility, size, and max).  Hours are counted in each student's timezone so they can be shifted when they are read.
+    """
+    students = list(students)
+    counts = student_counts(students, class_stats_options)
+    counts['timezone_hours'] = {}
+    for r in students:
+        hours = counts['timezone_hours'].setdefault(r['timezone'] or '', [0 for i in range(168)])
+        for i in range(168):
+            if r['hours'][i]:
+                hours[i] += 1
+    counts['groups'], counts['students_groups'] = 0, 0
+    counts['visibility'], counts['capacity'], counts['students_visibility'] = {}, {}, {}
+    for g in groups:
+        v, n = g['visibility'], g.get('size') or 0
+        counts['groups'] += 1
+        counts['students_groups'] += n
+        counts['visibility'][v] = counts['visibility'].get(v, 0) + 1
+        if not g.get('max') or not n or n < g['max']:
+            counts['capacity'][v] = counts['capacity'].get(v, 0) + 1
+        counts['students_visibility'][v] = counts['students_visibility'].get(v, 0) + n
+    # class_stats rows are stored as json, so use the same (string) keys
+    return json.loads(json.dumps(counts))
+
+def refresh_class_stats(class_id):
+    """ Recomputes the class_stats row for the specified class from scratch and returns its counts """
+    db = getdb()
+    counts = class_stats_counts(students_in_class(class_id), db.groups.search({'class_id': class_id}, projection=['visibility', 'size', 'max']))
+    db.class_stats.upsert({'class_id': class_id}, {'counts': counts, 'timestamp': datetime.datetime.now()})
+    return counts
+
+def class_counts(class_id, opts):
+    """ Returns a count dictionary for the specified class (see get_counts) using its class_stats row """
+    db = getdb()
+    r = db.class_stats.lucky({'class_id': class_id}, projection=['counts', 'timestamp'])
+    if r is None or r['timestamp'] + datetime.timedelta(seconds=CLASS_STATS_MAX_AGE) < datetime.datetime.now():
+        stats = refresh_class_stats(class_id)
+    else:
+        stats = r['counts']
+    counts = { opt: stats[opt] for opt in opts if opt in class_stats_options }
+    if 'hours' in opts:
+        hours = [0 for i in range(168)]
+        for tz, h in stats['timezone_hours'].items():
+            off = hours_from_default(tz)
+            for i in range(168):
+                hours[(i-off) % 168] += h[i]
+        counts['hours'] = hours
+    for k in ['students', 'groups', 'students_groups', 'visibility', 'capacity', 'students_visibility']:
+        counts[k] = stats[k]
+    return counts
+
+class ClassStatsUpdate():
+    """
+    Applies changes to the classlist rows of the specified students and to the specified groups in the specified classes
+    to the class_stats table as deltas.  Create one before making the changes and call apply once they are complete
+    (including updates to group sizes), in the same transaction.
+    """
+    def __init__(self, class_ids, student_ids=[], group_ids=[]):
+        self._db = getdb()
+        self.class_ids, self.student_ids, self.group_ids = set(class_ids), list(student_ids), list(group_ids)
+        self.before = { class_id: self._counts(class_id) for class_id in self.class_ids }
+
+    def _counts(self, class_id):
+        students = students_in_class(class_id, student_ids=self.student_ids) if self.student_ids else []
+        groups = self._db.groups.search({'class_id': class_id, 'id': {'$in': self.group_ids}}, projection=['visibility', 'size', 'max']) if self.group_ids else []
+        return class_stats_counts(students, groups)
+
+    def apply(self, class_ids=[], group_ids=[]):
+        """ Updates class_stats, including any classes our students were added to and groups that were created since we were created """
+        self.class_ids |= set(class_ids)
+        self.group_ids += list(group_ids)
+        for class_id in self.class_ids:
+            counts = lock_class_stats(class_id)
+            if counts is None:
+                continue # it will be computed from scratch when it is needed
+            add_counts(counts, self._counts(class_id))
+            if class_id in self.before:
+                add_counts(counts, self.before[class_id], -1)
+            self._db.class_stats.update({'class_id': class_id}, {'counts': counts}, resort=False)
+
 def get_counts(classes, opts, year=current_year(), term=current_term()):
     """ 
     Returns a dictionary of count dictionaries indexed by class numbers in classes ('' indicates totals across all classes).
@@ -470,21 +624,11 @@ def get_counts(classes, opts, year=current_year(), term=current_term()):
     db = getdb();
     counts = {}
     if '' in classes:
-        counts[''] = student_counts(students_in_classes(year=year, term=term), opts)
-        counts['']['classes'] = count_rows('classes', {'active':True, 'year': year, 'term': term})
-        counts['']['students_classes'] = count_rows('classlist', {'year': year, 'term': term})
-        counts['']['groups'] = count_rows('groups', {'year': year, 'term': term})
-        counts['']['students_groups'] = count_rows('grouplist', {'year': year, 'term': term})
-        counts['']['visibility'], counts['']['capacity'] = group_visibility_counts('')
-        counts['']['students_visibility'] = student_visibility_counts(db.groups.search({'year': year, 'term': term}, projection=["size", "visibility"]))
+        counts[''] = cached_term_counts(opts, year=year, term=term)
     for c in classes:
         if c:
             r = db.classes.lucky({'class_number': c, 'year': year, 'term': term},projection=["id","match_dates"])
-            counts[c] = student_counts(students_in_class(r['id']), opts)
-            counts[c]['groups'] = count_rows('groups',{'class_id': r['id']})
-            counts[c]['students_groups'] = count_rows('grouplist', {'class_id': r['id']})
-            counts[c]['visibility'], counts[c]['capacity'] = group_visibility_counts(c, year=year, term=term)
-            counts[c]['students_visibility'] = student_visibility_counts(db.groups.search({'class_id': r['id']}, projection=["size", "visibility"]))
+            counts[c] = class_counts(r['id'], opts)
             counts[c]['class_id'] = r['id']
     return counts
 
@@ -514,12 +658,23 @@ def class_groups(class_number, opts, year=current_year(), term=current_term(), v
         G.append(r)
     return sorted(G,key=lambda r: r[1])
 
+# sections of the data of a Student that are only loaded when they are used (see Student.section)
+student_sections = ["class_data", "suggestions", "group_data"]
+
+def materialized_sections():
+    """ Returns a Counter of the Student sections loaded while handling the current request (a new one outside requests) """
+    if not has_request_context():
+        return Counter()
+    if "materialized_sections" not in flask_g:
+        flask_g.materialized_sections = Counter()
+    return flask_g.materialized_sections
+
 def cleanse_student_data(data):
     kerb = data.get('kerb', "")
     for col in student_options:
         if data.get(col):
             if not data[col] in [r[0] for r in student_options[col]]:
-                app.logger.warning("Ignoring unknown %s %s for student %s"%(col,data[col],data,kerb))
+                app.logger.warning("Ignoring unknown %s %s for student %s"%(col,data[col],kerb))
                 data.col = None # None will get set later
     if data['preferences'] is None:
         data['preferences'] = {}
@@ -554,7 +709,29 @@ def cleanse_student_data(data):
     if data['departments']:
         data['departments'] = sorted(data['departments'], key=course_number_key)
 
-class Student(UserMixin):
+class AccountMixin():
+    """
+    Methods shared by Student, Instructor, and Principal that only involve the user's kerb, messages, and toggles.
+    Classes using it must define _db and _save_toggles.
+    """
+    def acknowledge(self, msgid=None):
+        if msgid is None:
+            self._db.messages.update({'recipient_kerb': self.kerb},{'read':True}, resort=False)
+        else:
+            self._db.messages.update({'recipient_kerb': self.kerb, 'id': msgid},{'read':True}, resort=False)
+        log_event (self.kerb, 'ok')
+        return "ok"
+
+    def update_toggle(self, name, value):
+        if not name:
+            return "no"
+        if self.toggles.get(name) == value:
+            return "ok"
+        self.toggles[name] = value;
+        self._save_toggles()
+        return "ok"
+
+class Student(AccountMixin, UserMixin):
     def __init__(self, kerb, full_name=''):
         if not kerb:
             raise ValueError("kerb required to create new student")
@@ -591,7 +768,10 @@ class Student(UserMixin):
         for col, typ in self._db.students.col_type.items():
             if getattr(self, col, None) is None:
                 setattr(self, col, default_value(typ))
-        self._reload()
+        # class_data, suggestions, and group_data are loaded on demand
+        self._sections, self._classes, self._groups = {}, None, None
+        # set by cached_student, sections loaded before any changes are made are saved here
+        self._snapshot = None
         assert self.kerb
 
     @property
@@ -654,10 +834,15 @@ class Student(UserMixin):
         if self.last_seen is None or self.last_seen + datetime.timedelta(hours=1) < now:
             self.last_seen = now
             self._db.students.update({'kerb': self.kerb},{'last_seen':now}, resort=False)
+            # the last seen time does not affect anything else we cache, so rather than bumping our version
+            # we update the cached copy of our data (if any) so that we don't write it again on every request
+            if self._snapshot is not None:
+                self._snapshot['last_seen'] = now
             log_event (self.kerb, 'seen')
 
     def login(self):
         self._db.students.update({'kerb': self.kerb},{'last_login':datetime.datetime.now()}, resort=False)
+        bump_student_version(self.kerb)
         log_event (self.kerb, 'login')
 
     def send_message(self, sender, typ, content):
@@ -668,14 +853,6 @@ class Student(UserMixin):
             content = ''.join(msg['content'].split('`')) # remove any backticks since we are using them as a separator
             flash_announce("%s`%s" % (msg['id'], content))
 
-    def acknowledge(self, msgid=None):
-        if msgid is None:
-            self._db.messages.update({'recipient_kerb': self.kerb},{'read':True}, resort=False)
-        else:
-            self._db.messages.update({'recipient_kerb': self.kerb, 'id': msgid},{'read':True}, resort=False)
-        log_event (self.kerb, 'ok')
-        return "ok"
-
     def confirm_conduct(self):
         self.conduct = True
         if self.new:
@@ -685,6 +862,7 @@ class Student(UserMixin):
             self.id = rec["id"]
         else:
             self._db.students.update({'id': self.id}, {'conduct': True}, resort=False)
+            bump_student_version(self.kerb)
         log_event(self.kerb, 'conduct')
         return "ok"
 
@@ -777,24 +955,65 @@ class Student(UserMixin):
             log_event (self.kerb, 'deny', detail={'request_id': request_id})
             return self._deny_request(request_id)
 
-    def update_toggle(self, name, value):
-        if not name:
-            return "no"
-        if self.toggles.get(name) == value:
-            return "ok"
-        self.toggles[name] = value;
-        self._save_toggles()
-        return "ok"
-
     def _save_toggles(self):
         self._db.students.update({'id': self.id}, {'toggles': self.toggles}, resort=False)
+        bump_student_version(self.kerb)
 
     def _reload(self):
         """ This function should be called after any updates to classlist or grouplist related this student """
-        self.class_data = self._class_data()
-        self.classes = sorted(list(self.class_data),key=class_number_key)
-        self.group_data = self._group_data()
-        self.groups = sorted(list(self.group_data))
+        self.invalidate()
+
+    def invalidate(self, *sections):
+        """ Discards the specified sections (all of them by default), they will be reloaded when they are next used """
+        for name in sections or student_sections:
+            self._sections.pop(name, None)
+        if not sections or "class_data" in sections:
+            self._classes = None
+        if not sections or "group_data" in sections:
+            self._groups = None
+        # our data is changing, so sections loaded from now on should not be cached
+        self._snapshot = None
+
+    def section(self, name):
+        """ Returns the section with the specified name (one of student_sections), loading it if needed """
+        if name not in self._sections:
+            value = self._sections[name] = getattr(self, "_" + name)()
+            materialized_sections()[name] += 1
+            if self._snapshot is not None:
+                self._snapshot["_sections"][name] = copy.deepcopy(value)
+        return self._sections[name]
+
+    @property
+    def class_data(self):
+        return self.section("class_data")
+
+    @class_data.setter
+    def class_data(self, value):
+        self._sections["class_data"] = value
+
+    @property
+    def suggestions(self):
+        return self.section("suggestions")
+
+    @property
+    def group_data(self):
+        return self.section("group_data")
+
+    @property
+    def classes(self):
+        if self._classes is None:
+            self._classes = sorted(list(self.class_data),key=class_number_key)
+        return self._classes
+
+    @classes.setter
+    def classes(self, value):
+        self._classes = value
+
+    @property
+    def groups(self):
+        if self._groups is None:
+            self._groups = sorted(list(self.group_data))
+        return self._groups
 
     def _save(self):
         if self.departments:
@@ -804,8 +1023,11 @@ class Student(UserMixin):
             rec = {col: getattr(self, col, None) for col in self._db.students.search_cols if col != "id"}
             self._db.students.insert_many([rec], resort=False)
             self.id = rec["id"]
+            stats = ClassStatsUpdate([], [self.id])
         else:
+            stats = ClassStatsUpdate(self._db.classlist.search({'student_id': self.id, 'year': current_year(), 'term': current_term()}, projection="class_id"), [self.id])
             self._db.students.update({"id": self.id, "kerb": self.kerb}, {col: getattr(self, col, None) for col in self._db.students.search_cols}, resort=False)
+        bump_student_version(self.kerb)
         if len(set(self.classes)) < len(self.classes):
             raise ValueError("Duplicates in class list %s" % self.classes)
         year = current_year()
@@ -854,6 +1076,11 @@ class Student(UserMixin):
                 n = len(list(self._db.classlist.search({'class_id': class_id},projection='id')))
                 self._db.classes.update({'id': class_id}, {'size': n}, resort=False)
                 log_event (self.kerb, 'drop', detail={'class_id': class_id})
+        # our profile affects suggestions for students who might join our groups (our own suggestions depend on our version)
+        for class_id in class_ids:
+            if self._db.grouplist.lucky({'class_id': class_id, 'student_id': self.id}, projection='group_id') is not None:
+                bump_class_version(class_id)
+        stats.apply(class_ids)
         self._reload()
         return "Changes saved!"
 
@@ -955,10 +1182,13 @@ class Student(UserMixin):
         if g['request_id']:
             app.logger.warning("User %s attempted to match group %s in class %s but the group has not responded to a previous request" % (self.kerb, group_id, g['class_id']))
             raise ValueError("Unable to join group in <b>%s</b>, this group does not currently allows membership by permission. You may be able to try again with a different group." % cs)
+        stats = ClassStatsUpdate([g['class_id']], [self.id])
         self._db.classlist.update({'class_id': g['class_id'], 'student_id': self.id}, {'status': 3, 'status_timestamp': now}, resort=False)
+        stats.apply()
         r = {'timestamp': now, 'group_id': g['id'], 'student_id': self.id, 'kerb': self.kerb}
         self._db.requests.insert_many([r])
         self._db.groups.update({'id': group_id}, {'request_id': r['id']}, resort=False)
+        bump_class_version(g['class_id'])
         approve_link = url_for("approve_request", request_id=r['id'], _external=True, _scheme="http" if debug_mode() else "https")
         deny_link = url_for("deny_request", request_id=r['id'], _external=True, _scheme="http" if debug_mode() else "https")
         request_msg = permission_request .format(class_numbers=' / '.join(g['class_numbers']), group_name=g['group_name'], approve_link=approve_link, deny_link=deny_link)
@@ -986,14 +1216,17 @@ class Student(UserMixin):
         s = self._db.students.lucky({'id': r['student_id']})
         assert s
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([g['class_id']], [r['student_id']], [g['id']])
         self._db.classlist.update({'class_id': g['class_id'], 'student_id': r['student_id']}, {'status': 1, 'status_timestamp': now}, resort=False)
         self._db.grouplist.insert_many([{'class_id': g['class_id'], 'class_number': g['class_number'], 'year': g['year'], 'term': g['term'],
                                          'group_id': g['id'], 'student_id': r['student_id'], 'kerb': r['kerb']}])        
         self._db.groups.update({'id': r['group_id'], 'request_id': r['id']}, {'request_id': None}, resort=False)
+        bump_class_version(g['class_id'])
         cs = ' / '.join(g['class_numbers'])
         hello_msg1 = "%s joined your pset group <b>%s</b> in <b>%s</b>!" % (pretty_name(s), g['group_name'], cs)
         hello_msg2 = "<br><br>You can contact your new partner at %s." % email_address(s)
         self._notify_group(g['id'], "Say hello to your new pset partner in %s!" % cs, hello_msg1+hello_msg2, hello_msg1) # updates group size
+        stats.apply()
         self.send_message('', 'approved', hello_msg1)
         send_message('', r['kerb'], 'approved', "Welcome to the <b>%s</b> pset group <b>%s</b>!" % (cs, g['group_name']))
         self.update_toggle('ct', g['class_number'])
@@ -1016,8 +1249,11 @@ class Student(UserMixin):
         if g['request_id'] != r['id']:
             return "This request has already been handled by you or another group member, but thanks for responding!"
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([g['class_id']], [r['student_id']], [g['id']])
         self._db.groups.update({'id': r['group_id'], 'request_id': r['id'], 'visibility': 1}, {'request_id': None, 'visibility': 0}, resort=False)
+        bump_class_version(g['class_id'])
         self._db.classlist.update({'class_id': g['class_id'], 'student_id': r['student_id']}, {'status': 0, 'status_timestamp': now}, resort=False)
+        stats.apply()
         cs = ' / '.join(g['class_numbers'])
         notify_msg = "%s updated the settings for the pset group <b>%s</b> in <b>%s</b>." % (self.preferred_name, g['group_name'], cs)
         self._notify_group(g['id'], "pset partner notification for %s" % cs, notify_msg, notify_msg)
@@ -1031,15 +1267,18 @@ class Student(UserMixin):
 
     def __join(self, g, checkin_pending=False):
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([g['class_id']], [self.id], [g['id']])
         self._db.classlist.update({'class_id': g['class_id'], 'student_id': self.id}, {'status': 1, 'status_timestamp': now, 'checkin_pending': checkin_pending}, resort=False)
         r = { k: g[k] for k in  ['class_id', 'class_number', 'year', 'term']}
         r['group_id'], r['student_id'], r['kerb'] = g['id'], self.id, self.kerb
         self._db.grouplist.insert_many([r], resort=False)
+        bump_class_version(g['class_id'])
         # note that size of group will be updated by _notify_group
         cs = ' / '.join(g['class_numbers'])
         hello_msg1 = "%s joined your pset group <b>%s</b> in <b>%s</b>!" % (self.pretty_name, g['group_name'], ' / '.join(g['class_numbers']))
         hello_msg2 = "<br><br>You can contact your new partner at %s." % self.email_address
         self._notify_group(g['id'], "Say hello to your new pset partner in %s!" % cs, hello_msg1+hello_msg2, hello_msg1) # updates group size
+        stats.apply()
         self._reload()
         return "Welcome to <b>%s</b>!" % g['group_name']
 
@@ -1055,10 +1294,12 @@ class Student(UserMixin):
             app.logger.warning("User %s attempted to leave group %s in class %s not in their group list" % (self.kerb, group_id, g['class_id']))
             raise ValueError("Group not found in your list of groups for this term.")
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([g['class_id']], [self.id], [group_id])
         r = self._db.grouplist.lucky({'group_id': group_id, 'student_id': self.id})
         r['timestamp'] = now
         self._db.grouplistleft.insert_many([r], resort=False)
         self._db.grouplist.delete({'group_id': group_id, 'student_id': self.id})
+        bump_class_version(g['class_id'])
         self._db.classlist.update({'class_id': g['class_id'], 'student_id': self.id}, {'status': 0, 'status_timestamp': now}, resort=False)
         cs = ' / '.join(g['class_numbers'])
         msg = "You have been removed from the group <b>%s</b> in <b>%s</b>." % (g['group_name'], cs)
@@ -1069,6 +1310,7 @@ class Student(UserMixin):
             # note that size of group will be updated by _notify_group
             leave_msg = "%s (kerb=%s) left the pset group <b>%s</b> in <b>%s</b>." % (self.preferred_name, self.kerb, g['group_name'], cs)
             self._notify_group(group_id, "pset partner notification for %s" % cs, leave_msg, leave_msg)
+        stats.apply()
         self._reload()
         return msg
 
@@ -1090,7 +1332,10 @@ class Student(UserMixin):
         d,_ = next_match_date(class_id)
         msg = "You are now in the match pool for <b>%s</b> and will be matched on <b>%s</b>." %(cs, d)
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([class_id], [self.id])
         self._db.classlist.update({'class_id': class_id, 'student_id': self.id}, {'status': 2, 'status_timestamp': now}, resort=False)
+        bump_student_version(self.kerb)
+        stats.apply()
         self._reload()
         return msg
 
@@ -1115,7 +1360,10 @@ class Student(UserMixin):
         d,_ = next_match_date(class_id)
         msg = "You have been removed from the match pool for <b>%s</b> on <b>%s</b>." %(cs, d)
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([class_id], [self.id])
         self._db.classlist.update({'class_id': class_id, 'student_id': self.id}, {'status': 0, 'status_timestamp': now}, resort=False)
+        bump_student_version(self.kerb)
+        stats.apply()
         self._reload()
         return msg
 
@@ -1143,14 +1391,17 @@ class Student(UserMixin):
         limit = max_size_from_prefs(prefs)
         name = generate_group_name(class_id)
         now = datetime.datetime.now()
+        stats = ClassStatsUpdate([class_id], [self.id])
         g = {'class_id': class_id, 'year': current_year(), 'term': current_term(), 'class_number': c['class_number'], 'class_numbers': c['class_numbers'], 'group_name': name,
              'visibility': visibility, 'preferences': prefs, 'strengths': strengths, 'created': now, 'creator': self.kerb, 'editors': editors,
              'size': 1, 'max': limit }
         self._db.groups.insert_many([g], resort=False)
         r = {'class_id': class_id, 'group_id': g['id'], 'student_id': self.id, 'kerb': self.kerb, 'class_number': g['class_number'], 'year': g['year'], 'term': g['term'] }
         self._db.grouplist.insert_many([r], resort=False)
+        bump_class_version(class_id)
         now = datetime.datetime.now()
         self._db.classlist.update({'class_id': class_id, 'student_id': self.id}, {'status':1, 'status_timestamp': now}, resort=False)
+        stats.apply(group_ids=[g['id']])
         self._reload()
         return "Created the group <b>%s</b> in <b>%s</b>!" % (g['group_name'], cs)
 
@@ -1181,7 +1432,10 @@ class Student(UserMixin):
             raise ValueError("Invalid URL")
         limit = max_size_from_prefs(prefs)
         if any([g['visibility'] != visibility, g['editors'] != editors, g['preferences'] != prefs, g['description'] != description, g['link'] != link]):
+            stats = ClassStatsUpdate([g['class_id']], [], [group_id])
             self._db.groups.update({'id': group_id}, {'preferences': prefs, 'visibility': visibility, 'editors': editors, 'max': limit, 'description': description, 'link': link}, resort=False)
+            stats.apply()
+            bump_class_version(g['class_id'])
             notify_msg = "%s updated the settings for the pset group <b>%s</b> in <b>%s</b>." % (self.preferred_name, g['group_name'], cs)
             self._notify_group(group_id, "pset partner notification for %s" % cs, notify_msg, notify_msg)
             self._reload()
@@ -1201,7 +1455,10 @@ class Student(UserMixin):
             return "This request has already been handled by you or another group member, but thanks for responding!"
         g['preferences'].pop('size')
         cs = ' / '.join(g['class_numbers'])
+        stats = ClassStatsUpdate([g['class_id']], [], [group_id])
         self._db.groups.update({'id': group_id}, {'preferences': g['preferences'], 'max': None}, resort=False)
+        stats.apply()
+        bump_class_version(g['class_id'])
         notify_msg = "%s updated the settings for the pset group <b>%s</b> in <b>%s</b>." % (self.preferred_name, g['group_name'], cs)
         self._notify_group(group_id, "pset partner notification for %s" % cs, notify_msg, notify_msg)
         self.update_toggle('ct', g['class_number'])
@@ -1237,26 +1494,33 @@ class Student(UserMixin):
             # timeout expired request status
             if r['status'] == 3 and r['status_timestamp'] + datetime.timedelta(days=1) < now:
                 r['status'] = 0
+            # suggestions depend on our profile as well as the groups in the class (see _suggestions)
+            r['class_version'] = None if c.get('version') is None else (c['version'], self.version)
+            class_data[r["class_number"]] = r
+        return class_data
+
+    def _suggestions(self):
+        """ Returns a dictionary keyed by class number of the groups suggested to this student in classes where they are not in a group """
+        suggestions = {}
+        now = datetime.datetime.now()
+        for class_number, r in self.class_data.items():
             if r['status'] in [0,2]:
                 # Don't make suggestions to students who have left 2 or more groups in the class recently
                 S=list(self._db.grouplistleft.search({'class_id':r['class_id'], 'student_id': self.id},projection='timestamp'))
                 if len(S) < 2 or S[-2] + datetime.timedelta(hours=19) < now:
                     # Suggest matches for groups with relative compatibility > -162
-                    candidates = [g for g in rank_groups(r['class_id'], self.kerb) if g[1] >= 1 and g[2] >= -162]
+                    candidates = [g for g in ranked_groups(r['class_id'], self.id, self.kerb, r['class_version']) if g[1] >= 1 and g[2] >= -162]
+                    s = suggestions[class_number] = {}
                     suggest = [g for g in candidates if g[1] == 1]
                     if suggest:
-                        r['permission_match'] = suggest[0][0]
-                        # print("permission match: %s" % r['permission_match'])
+                        s['permission_match'] = suggest[0][0]
                     suggest = [g for g in candidates if g[1] == 2]
                     if suggest:
-                        r['automatic_match'] = suggest[0][0]
-                        # print("automatic match: %s" % r['automatic_match'])
+                        s['automatic_match'] = suggest[0][0]
                     suggest = [g for g in candidates if g[1] == 3]
                     if suggest:
-                        r['public_match'] = suggest[0][0]
-                        # print("public match: %s" % r['public_match'])
-            class_data[r["class_number"]] = r
-        return class_data
+                        s['public_match'] = suggest[0][0]
+        return suggestions
 
     def _group_data(self, year=current_year(), term=current_term()):
         group_data = {}
@@ -1278,11 +1542,55 @@ class Student(UserMixin):
             group_data[g['class_number']] = g
         return group_data
 
+# Students loaded by cached_student in this process, keyed by (live, kerb), values are triples (version, timestamp, data)
+# where version is the student's data version (see dbwrapper.student_data_version) and data is a copy of the student's attributes
+_student_cache = OrderedDict()
+STUDENT_CACHE_SIZE = 1024
+# time limit in seconds for reusing cached students (some of their data, e.g. next match dates, depends on the time)
+STUDENT_CACHE_TTL = 300
+# number of calls to cached_student in this process that reused cached data (hits) or loaded the student (misses)
+student_cache_stats = {'hits': 0, 'misses': 0}
+
+def cached_student(kerb, full_name=''):
+    """
+    Returns Student(kerb, full_name), reusing the data loaded for the student by a previous call in this process if
+    the student's data version has not changed since and it was loaded less than STUDENT_CACHE_TTL seconds ago.
+    The version of the student (see dbwrapper.bump_student_version) must be bumped whenever their students or classlist
+    rows change, and the version of the class (see dbwrapper.bump_class_version) whenever a group in the class changes.
+    Each call returns a new Student object, so changes to one (e.g. by a request that fails) never affect the cache,
+    but sections of the student's data loaded before any changes are made are added to the cache.
+    """
+    db = getdb()
+    key = (db_islive(db), kerb)
+    version = student_data_version(kerb)
+    now = time.time()
+    entry = _student_cache.get(key)
+    if version is not None and entry is not None and entry[0] == version and now < entry[1] + STUDENT_CACHE_TTL:
+        _student_cache.move_to_end(key)
+        student_cache_stats['hits'] += 1
+        s = Student.__new__(Student)
+        s.__dict__.update(copy.deepcopy(entry[2]))
+        s._db = db
+        s._snapshot = entry[2]
+        return s
+    student_cache_stats['misses'] += 1
+    s = Student(kerb, full_name)
+    if version is None or s.new:
+        _student_cache.pop(key, None)
+        return s
+    # sections are added to the snapshot as they are loaded (see Student.section)
+    s._snapshot = copy.deepcopy({k: v for k, v in s.__dict__.items() if k not in ['_db', '_snapshot']})
+    _student_cache[key] = (version, now, s._snapshot)
+    _student_cache.move_to_end(key)
+    if len(_student_cache) > STUDENT_CACHE_SIZE:
+        _student_cache.popitem(last=False)
+    return s
+
 def cleanse_instructor_data(data):
     if data['toggles'] is None:
         data['toggles'] = {}
 
-class Instructor(UserMixin):
+class Instructor(AccountMixin, UserMixin):
     def __init__(self, kerb, full_name='', affiliation=''):
         if not kerb:
             raise ValueError("kerb required to create new instructor")
@@ -1323,14 +1631,6 @@ class Instructor(UserMixin):
         self._reload()
         assert self.kerb
 
-    def acknowledge(self, msgid=None):
-        if msgid is None:
-            self._db.messages.update({'recipient_kerb': self.kerb},{'read':True}, resort=False)
-        else:
-            self._db.messages.update({'recipient_kerb': self.kerb, 'id': msgid},{'read':True}, resort=False)
-        log_event (self.kerb, 'ok')
-        return "ok"
-
     def activate(self, class_id):
         with DelayCommit(self):
             log_event (self.kerb, 'activate', {'class_id': class_id})
@@ -1341,15 +1641,6 @@ class Instructor(UserMixin):
             log_event (self.kerb, 'update', {'class_id': class_id, 'data': data})
             return self._update_class(class_id, data)
 
-    def update_toggle(self, name, value):
-        if not name:
-            return "no"
-        if self.toggles.get(name) == value:
-            return "ok"
-        self.toggles[name] = value;
-        self._save_toggles()
-        return "ok"
-
     def _save_toggles(self):
         self._db.instructors.update({'kerb': self.kerb}, {'toggles': self.toggles}, resort=False)
 
@@ -1372,6 +1663,7 @@ class Instructor(UserMixin):
                 raise ValueError("Error activating class, your kerberos id does not match that of the owner of this class -- this should never happen and most likely indicates a bug, please contact psetpartners@mit.edu for assistence.")
         msg = "<b>%s</b> is now active on pset partners!" %(' / '.join(c['class_numbers']))
         self._db.classes.update({'id': class_id}, {'active': True}, resort=False)
+        bump_class_version(class_id)
         self._reload()
         return msg
 
@@ -1455,7 +1747,9 @@ class Instructor(UserMixin):
             if match_dates != c['match_dates']:
                 match_date_change = True
                 c['match_dates'] = match_dates
+        c.pop('version', None) # bumped below (not overwritten with the value we read)
         self._db.classes.update({'id': class_id}, c, resort=False)
+        bump_class_version(class_id)
         self._reload()
         msg = "<b>%s</b> has been updated." % cs
         if c['instructor_kerbs'] != instructor_kerbs and self.kerb != c['owner_kerb']:
@@ -1601,3 +1895,81 @@ class AnonymousUser(AnonymousUserMixin):
     @property
     def get_id(self):
         return None
+
+
+class Principal(AccountMixin, UserMixin):
+    """
+    Lightweight stand-in for a Student or Instructor used by routes that only need to know who the caller is (see
+    lightweight in main.py).  Only the kerb and role come from the session, the rest of the caller's students or
+    instructors row is fetched (with a single lookup) the first time any of it is used.
+    """
+    def __init__(self, kerb, affiliation=''):
+        if not kerb:
+            raise ValueError("kerb required to create principal")
+        self._db = getdb()
+        self._fetched = False
+        self.kerb = kerb
+        self.affiliation = affiliation
+
+    def __getattr__(self, name):
+        # only called for attributes we don't have, which we fetch on first use
+        if name.startswith('_') or self._fetched:
+            raise AttributeError(name)
+        self._fetch()
+        return getattr(self, name)
+
+    def _fetch(self):
+        self._fetched = True
+        data = self._table.lookup(self.kerb)
+        data = { col: None for col in self._table.col_type } if data is None else data
+        for col, typ in self._table.col_type.items():
+            if data.get(col) is None:
+                data[col] = default_value(typ)
+        data['kerb'] = self.kerb
+        self.__dict__.update(data)
+
+    @property
+    def _table(self):
+        return self._db.students if self.is_student else self._db.instructors
+
+    @property
+    def is_student(self):
+        return self.affiliation == "student"
+
+    @property
+    def is_instructor(self):
+        return not self.is_student
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_admin(self):
+        return is_admin(self.kerb)
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    @property
+    def tz(self):
+        if not getattr(self,'timezone',"") or self.timezone == DEFAULT_TIMEZONE_NAME:
+            return timezone(DEFAULT_TIMEZONE)
+        try:
+            return timezone(self.timezone)
+        except UnknownTimeZoneError:
+            return timezone(DEFAULT_TIMEZONE)
+
+    @property
+    def dual_role(self):
+        return is_current_instructor(self.kerb) if self.is_student else is_student(self.kerb)
+
+    @property
+    def get_id(self):
+        return lambda: self.kerb
+
+    def _save_toggles(self):
+        self._table.update({'kerb': self.kerb}, {'toggles': self.toggles}, resort=False)
+        if self.is_student:
+            bump_student_version(self.kerb)
@@ -2,6 +2,7 @@
 
 import pytz, datetime, logging
 import re, ast
+from collections import defaultdict
 from collections.abc import Iterable
 from markupsafe import Markup, escape
 from flask import flash, render_template, request
@@ -168,6 +169,134 @@ def hours_from_default(tz):
         hours += 1
     return hours if delta >= 0 else -hours
 
+HOURS_MASK = (1 << 168) - 1
+
+class Availability(object):
+    """
+    A set of hours in the week (0-167) stored as the bits of a single int, so that intersections
+    are a single AND and counts are a single popcount.
+    """
+    __slots__ = ["bits"]
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    @classmethod
+    def from_hours(cls, hours, timezone=None):
+        """ Creates an instance from a list of 168 booleans in the specified timezone, normalized to MIT time """
+        bits = 0
+        if hours:
+            for i in range(168):
+                if hours[i]:
+                    bits |= 1 << i
+        offset = hours_from_default(timezone) % 168
+        if offset:
+            bits = ((bits << offset) | (bits >> (168 - offset))) & HOURS_MASK
+        return cls(bits)
+
+    @classmethod
+    def intersection(cls, availabilities):
+        """ Returns the hours common to all of the availabilities (the empty set if there are none) """
+        bits = None
+        for A in availabilities:
+            bits = A.bits if bits is None else bits & A.bits
+        return cls(bits or 0)
+
+    def __and__(self, other):
+        return Availability(self.bits & other.bits)
+
+    def __or__(self, other):
+        return Availability(self.bits | other.bits)
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __getitem__(self, i):
+        return bool((self.bits >> i) & 1)
+
+    def __iter__(self):
+        """ Iterates over the hours in the set in increasing order """
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def __eq__(self, other):
+        return isinstance(other, Availability) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return "Availability(%s)" % list(self)
+
+class AvailabilityCounts(object):
+    """
+    Per-hour counts of the number of available members of a group, maintained incrementally as members
+    are added and removed.  The hours with a given count are available as an Availability (computed once
+    per change), which makes it cheap to evaluate what replacing one member by another would do.
+    """
+    __slots__ = ["n", "counts", "_levels"]
+
+    def __init__(self, availabilities=[]):
+        self.n = 0
+        self.counts = [0] * 168
+        self._levels = None
+        for A in availabilities:
+            self.add(A)
+
+    def add(self, A):
+        for h in A:
+            self.counts[h] += 1
+        self.n += 1
+        self._levels = None
+
+    def remove(self, A):
+        for h in A:
+            self.counts[h] -= 1
+        self.n -= 1
+        self._levels = None
+
+    def level(self, k):
+        """ Returns the bits of the hours at which exactly k members are available """
+        if self._levels is None:
+            levels = defaultdict(int)
+            for h, c in enumerate(self.counts):
+                levels[c] |= 1 << h
+            self._levels = levels
+        return self._levels.get(k, 0)
+
+    def replaced_level(self, k, A, B):
+        """ Returns the bits of the hours at which exactly k members would be available if a member with availability A were replaced by one with availability B """
+        a, b = A.bits, B.bits
+        return (self.level(k) & ~(a ^ b)) | (self.level(k+1) & a & ~b) | (self.level(k-1) & b & ~a)
+
+    def overlap(self):
+        """ Returns the hours at which every member is available """
+        return Availability(self.level(self.n) if self.n else 0)
+
+    def replaced_overlap(self, A, B):
+        """ Returns the hours at which every member would be available if a member with availability A were replaced by one with availability B """
+        return Availability(self.replaced_level(self.n, A, B))
+
+    def leave_one_out(self, availabilities, replaced=None):
+        """
+        Returns a list containing, for each of the given member availabilities, the number of hours at which all
+        the other members are available, which is the number of hours with count n, plus the number with count n-1
+        at which the member left out is unavailable.  If replaced=(A, B) is specified, the counts are those that
+        would result from replacing a member with availability A by one with availability B.
+        """
+        n = self.n
+        if replaced is None:
+            full, almost = self.level(n), self.level(n-1)
+        else:
+            full, almost = self.replaced_level(n, *replaced), self.replaced_level(n-1, *replaced)
+        return [(full | (almost & ~A.bits)).bit_count() for A in availabilities]
+
 def pretty_timezone(tz, dest="selecter", base_name='UTC', base_timezone='UTC'):
     delta = int(naive_utcoffset(tz).total_seconds()) - int(naive_utcoffset(base_timezone).total_seconds())
     hours, remainder = divmod(abs(delta), 3600)